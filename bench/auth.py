@@ -0,0 +1,73 @@
+"""Measure message authentication throughput.
+
+Run from the repository root with: python -m bench.auth
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import hmac
+import time
+
+from scrambler.auth import Auth
+
+
+KEY = "35lkjsd98f79235lkjsdf098235"
+
+
+def rate(func, messages):
+    """Return calls per second of func over messages."""
+
+    start = time.time()
+    for message in messages:
+        func(*message)
+    return len(messages) / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--size", type=int, default=1024)
+    args = parser.parse_args()
+
+    auth = Auth(KEY, "bench")
+    nodes = ["node{:04d}".format(n) for n in range(args.nodes)]
+    digests = dict((node, Auth(KEY, node).digest()) for node in nodes)
+    payload = "x" * args.size
+
+    # One message per node per round, like a heartbeat storm
+    messages = [
+        (digests[node], node)
+        for _ in range(args.rounds)
+        for node in nodes
+    ]
+    signed = [
+        (auth.sign("cluster", node, "\x00", payload), "cluster", node,
+         "\x00", payload)
+        for node in nodes
+    ] * args.rounds
+
+    results = [
+        (
+            "rekeyed node digest",
+            rate(
+                lambda digest, node:
+                    hmac.new(KEY, node).hexdigest() == digest,
+                messages
+            )
+        ),
+        ("cached node digest", rate(auth.verify, messages)),
+        (
+            "payload signature ({}B)".format(args.size),
+            rate(auth.verify_signature, signed)
+        )
+    ]
+
+    print("{} messages from {} nodes".format(len(messages), args.nodes))
+    for label, value in results:
+        print("{:<28} {:>12.0f} msg/s".format(label, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Compare PubSub payload codecs on bytes and encode/decode time.
+
+Run from the repository root with: python -m bench.codec
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import hashlib
+import timeit
+
+from scrambler.codec import Codec, msgpack
+
+
+def uuid(seed):
+    """Return a docker-like 64 character container id."""
+
+    return hashlib.sha256(str(seed)).hexdigest()
+
+
+def cluster_payload():
+    """Return a cluster announcement."""
+
+    return {"address": "10.127.0.42", "master": False}
+
+
+def docker_payload(images, containers):
+    """Return a full docker state checkpoint."""
+
+    return {
+        "epoch": uuid("epoch")[:32],
+        "version": 1234,
+        "type": "full",
+        "state": {
+            "registry.docker:5000/service{}:latest".format(i): {
+                uuid((i, j)): {
+                    "name": "/service{}_{}".format(i, j),
+                    "state": True
+                }
+                for j in range(containers)
+            }
+            for i in range(images)
+        }
+    }
+
+
+def schedule_payload(nodes, actions):
+    """Return a schedule message."""
+
+    return {
+        "node{:04d}".format(n): {
+            "actions": [
+                {
+                    "do": "run",
+                    "image": "registry.docker:5000/service{}:latest".format(a),
+                    "name": "service{}".format(a),
+                    "config": {"ports": {"2222": "22"}}
+                }
+                if a % 2 else
+                {
+                    "do": "die",
+                    "uuid": uuid((n, a))
+                }
+                for a in range(actions)
+            ]
+        }
+        for n in range(nodes)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=200)
+    parser.add_argument("--compress", type=int, default=1024)
+    args = parser.parse_args()
+
+    payloads = [
+        ("cluster", cluster_payload()),
+        ("docker/10", docker_payload(5, 2)),
+        ("docker/500", docker_payload(25, 20)),
+        ("schedule", schedule_payload(50, 4))
+    ]
+
+    codecs = [("json", 0), ("json", args.compress)]
+    if msgpack is not None:
+        codecs.extend([("msgpack", 0), ("msgpack", args.compress)])
+
+    print("{:<12} {:<16} {:>9} {:>12} {:>12}".format(
+        "payload", "codec", "bytes", "encode us", "decode us"
+    ))
+
+    for label, data in payloads:
+        for name, compress in codecs:
+            codec = Codec(name, compress)
+            header, payload = codec.encode(data)
+
+            encode = timeit.timeit(
+                lambda: codec.encode(data),
+                number=args.number
+            )
+            decode = timeit.timeit(
+                lambda: codec.decode(header, payload),
+                number=args.number
+            )
+
+            print("{:<12} {:<16} {:>9} {:>12.1f} {:>12.1f}".format(
+                label,
+                name + ("+zlib" if compress else ""),
+                len(payload) + (0 if codec.legacy() else 1),
+                encode / args.number * 1e6,
+                decode / args.number * 1e6
+            ))
+
+
+if __name__ == "__main__":
+    main()
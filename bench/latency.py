@@ -0,0 +1,132 @@
+"""Compare message latency through PubSub on threads and on the reactor.
+
+Each message is handed from subscriber to publisher for a number of hops,
+like a death going through the cluster listener, the scheduler and the
+docker handler, over loopback so no network is needed.
+
+Run from the repository root with: python -m bench.latency
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import Queue
+import tempfile
+import threading
+import time
+
+from scrambler.pubsub import PubSub
+from scrambler.reactor import Reactor
+from scrambler.threads import Threads
+
+
+def config(path):
+    """Return enough config for a PubSub on a local socket."""
+
+    return {
+        "hostname": "bench",
+        "connection": {
+            "interface": "",
+            "group": path,
+            "port": "0",
+            "protocol": "ipc"
+        },
+        "codec": {"name": "json", "compress": 0},
+        "auth": {"cluster_key": "bench", "sign": False},
+        "trace": False,
+        "queues": {
+            "publisher": {"size": 10000, "batch": 100},
+            "subscriber": {"size": 10000, "overflow": "conflate"}
+        }
+    }
+
+
+class Hops():
+    """Relay messages for a number of hops, timing the whole trip."""
+
+    def __init__(self, pubsub, hops):
+        self._pubsub = pubsub
+        self._hops = hops
+        self._latencies = []
+        self._done = threading.Event()
+
+    def send(self):
+        self._done.clear()
+        self._pubsub.publish(
+            "bench",
+            {"sent": time.time(), "hop": 1},
+            loopback=True
+        )
+
+    def handle(self, key, node, data, trace=None):
+        if data["hop"] < self._hops:
+            self._pubsub.publish(
+                "bench",
+                dict(data, hop=data["hop"] + 1),
+                loopback=True
+            )
+        else:
+            self._latencies.append(time.time() - data["sent"])
+            self._done.set()
+
+    def listen(self, queue):
+        """Consume queue like the agent's threads do."""
+
+        while True:
+            try:
+                key, node, data, trace = queue.get(timeout=1)
+                queue.task_done()
+                self.handle(key, node, data, trace)
+            except Queue.Empty:
+                continue
+
+    def run(self, messages, gap):
+        for _ in range(messages):
+            self.send()
+            self._done.wait(10)
+            time.sleep(gap)
+
+        latencies = sorted(self._latencies)
+        return [
+            latencies[int(len(latencies) * q)] * 1000
+            for q in [0.5, 0.99]
+        ] + [latencies[-1] * 1000]
+
+
+def threaded(path, args):
+    pubsub = PubSub(config(path))
+    hops = Hops(pubsub, args.hops)
+    queue = pubsub.subscribe("bench")
+    Threads([lambda: hops.listen(queue)])
+    return hops.run(args.messages, args.gap)
+
+
+def reactor(path, args):
+    loop = Reactor()
+    pubsub = PubSub(config(path), loop)
+    hops = Hops(pubsub, args.hops)
+    pubsub.subscribe("bench", hops.handle)
+    Threads([loop.run])
+    return hops.run(args.messages, args.gap)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--hops", type=int, default=3)
+    parser.add_argument("--gap", type=float, default=0.01)
+    args = parser.parse_args()
+
+    print("{} messages of {} hops, {}s apart".format(
+        args.messages, args.hops, args.gap
+    ))
+    for label, runtime in [("threaded", threaded), ("reactor", reactor)]:
+        path = tempfile.mktemp(prefix="scrambler-bench-")
+        p50, p99, worst = runtime(path, args)
+        print("{:<10} p50 {:>8.3f}ms  p99 {:>8.3f}ms  max {:>8.3f}ms".format(
+            label, p50, p99, worst
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Measure Store throughput under reader/writer contention.
+
+Run from the repository root with: python -m bench.rwlock
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import random
+import threading
+import time
+
+from scrambler.rwlock import RWLock
+from scrambler.store import Store
+from scrambler.synchronized import synchronized
+
+
+class ExclusiveLock():
+    """Provide RWLock interface over a single mutex, as a baseline."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def read_acquire(self, timeout=None):
+        self._lock.acquire()
+
+    def read_release(self):
+        self._lock.release()
+
+    def write_acquire(self, timeout=None):
+        self._lock.acquire()
+
+    def write_release(self):
+        self._lock.release()
+
+
+class SlowStore(Store):
+    """Provide Store whose reads hold the lock while blocked, like I/O."""
+
+    def __init__(self, initialize, hold):
+        Store.__init__(self, initialize)
+        self._hold = hold
+
+    @synchronized("read")
+    def get(self, key, default=None):
+        time.sleep(self._hold)
+        return self._store.get(key, default)
+
+
+def run(lock, args):
+    """Return (ops/s, worst write wait) for args.threads threads."""
+
+    store = SlowStore(dict((n, n) for n in range(100)), args.hold)
+    store._rwlock = lock
+
+    counts = [0] * args.threads
+    waits = [0.0] * args.threads
+    deadline = time.time() + args.duration
+
+    def worker(index):
+        rand = random.Random(index)
+        while time.time() < deadline:
+            key = rand.randrange(100)
+            if rand.random() < args.writes:
+                start = time.time()
+                store[key] = key
+                waits[index] = max(waits[index], time.time() - start)
+            else:
+                store.get(key)
+            counts[index] += 1
+
+    threads = [
+        threading.Thread(target=worker, args=(index,))
+        for index in range(args.threads)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sum(counts) / args.duration, max(waits)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--writes", type=float, default=0.05)
+    parser.add_argument("--hold", type=float, default=0.001)
+    parser.add_argument("--duration", type=float, default=3)
+    args = parser.parse_args()
+
+    print("{} threads, {:.0%} writes, {}s read hold".format(
+        args.threads, args.writes, args.hold
+    ))
+    for label, lock in [("exclusive", ExclusiveLock()), ("rwlock", RWLock())]:
+        ops, wait = run(lock, args)
+        print("{:<10} {:>10.0f} ops/s  worst write wait {:.3f}s".format(
+            label, ops, wait
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""Benchmark and simulate schedulers over synthetic cluster state.
+
+Run from the repository root with: python -m bench.scheduler
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import random
+import resource
+import time
+
+from scrambler import scheduler
+from scrambler.store import SnapshotStore, merge
+
+
+def maxrss():
+    """Return peak resident memory in MiB."""
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def percentile(values, fraction):
+    """Return the value at fraction of the sorted values."""
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Simulation():
+    """Provide synthetic cluster for driving a scheduler offline."""
+
+    def __init__(self, args):
+        self._random = random.Random(args.seed)
+        self._serial = 0
+
+        # Nodes
+        self.nodes = ["node{:05d}".format(n) for n in range(args.nodes)]
+
+        # Policies, some linked to the one before for affinity
+        self.policies = {}
+        for p in range(args.policies):
+            minimum = self._random.randint(1, 5)
+            policy = {
+                "name": "service{}".format(p),
+                "min": minimum,
+                "max": self._random.choice(
+                    [-1, minimum, minimum + self._random.randint(1, 5)]
+                ),
+                "links": [],
+                "affinity": self._random.random() < args.affinity,
+                "strict": self._random.random() < 0.5,
+                "config": {"ports": {"2222": "22"}}
+            }
+            if policy["affinity"] and p:
+                policy["links"] = [{"service{}".format(p - 1): "linked"}]
+            self.policies[
+                "registry.docker:5000/service{}:latest".format(p)
+            ] = policy
+
+        # Containers, skewed towards low-numbered nodes and images
+        images = sorted(self.policies)
+        state = dict((node, {}) for node in self.nodes)
+        for _ in range(args.containers):
+            node = self.nodes[self._skewed(len(self.nodes), args.skew)]
+            image = images[self._skewed(len(images), args.skew)]
+            state[node].setdefault(image, {})[self._uuid()] = {
+                "name": "/container{}".format(self._serial),
+                "state": True
+            }
+
+        self.cluster_state = SnapshotStore(
+            dict(
+                (node, {"address": "127.0.0.1", "master": False})
+                for node in self.nodes
+            )
+        )
+        self.docker_state = SnapshotStore(state)
+
+    def _skewed(self, count, skew):
+        """Return index in range(count), favouring low ones if skewed."""
+
+        return min(count - 1, int(count * self._random.random() ** skew))
+
+    def _uuid(self):
+        """Return a new container id."""
+
+        self._serial += 1
+        return "{:064x}".format(self._serial)
+
+    def _commit(self, deltas):
+        """Merge per-node deltas into docker state in a single write."""
+
+        self.docker_state.update(
+            dict(
+                (node, merge(self.docker_state[node], delta, 2))
+                for node, delta in deltas.items()
+            )
+        )
+
+    def apply(self, actions):
+        """Apply scheduled actions to docker state as if they'd run."""
+
+        deltas = {}
+
+        for node, scheduled in actions.items():
+            delta = deltas.setdefault(node, {})
+            for action in scheduled["actions"]:
+                if action["do"] == "run":
+                    delta.setdefault(action["image"], {})[self._uuid()] = {
+                        "name": "/" + action["name"],
+                        "state": True
+                    }
+                elif action["do"] == "die":
+                    for image, containers in self.docker_state[node].items():
+                        if action["uuid"] in containers:
+                            delta.setdefault(image, {})[action["uuid"]] = None
+                            break
+
+        self._commit(deltas)
+
+    def churn(self, count):
+        """Kill count random containers."""
+
+        deltas = {}
+
+        for _ in range(count):
+            node = self._random.choice(self.nodes)
+            images = self.docker_state[node]
+            if images:
+                image = self._random.choice(sorted(images))
+                uuid = self._random.choice(sorted(images[image]))
+                deltas.setdefault(node, {}).setdefault(image, {})[uuid] = None
+
+        self._commit(deltas)
+
+
+def count(actions):
+    """Return number of actions in a schedule."""
+
+    return sum(len(scheduled["actions"]) for scheduled in actions.values())
+
+
+def fresh(actions, previous):
+    """Return schedule of the actions not in the previous schedule.
+
+    Leased actions are sent again each pass until they show up in state,
+    as the same objects, and holding the previous schedule keeps their ids
+    from being reused.
+    """
+
+    sent = set(
+        id(action)
+        for scheduled in previous.values()
+        for action in scheduled["actions"]
+    )
+
+    schedule = {}
+    for node, scheduled in actions.items():
+        new = [
+            action
+            for action in scheduled["actions"]
+            if id(action) not in sent
+        ]
+        if new:
+            schedule[node] = {"actions": new}
+
+    return schedule
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scheduler", default="BinPack")
+    parser.add_argument("--nodes", type=int, default=1000)
+    parser.add_argument("--policies", type=int, default=100)
+    parser.add_argument("--containers", type=int, default=5000)
+    parser.add_argument("--skew", type=float, default=2.0)
+    parser.add_argument("--affinity", type=float, default=0.1)
+    parser.add_argument("--passes", type=int, default=50)
+    parser.add_argument("--churn", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--lease", type=float, default=60)
+    args = parser.parse_args()
+
+    start = time.time()
+    simulation = Simulation(args)
+    algorithm = getattr(scheduler, args.scheduler)(
+        simulation.policies,
+        simulation.cluster_state,
+        simulation.docker_state,
+        args.lease or None
+    )
+    print("{}: {} nodes, {} policies, {} containers".format(
+        args.scheduler, args.nodes, args.policies, args.containers
+    ))
+    print("setup     {:>9.1f} ms  {:>7.1f} MiB".format(
+        (time.time() - start) * 1e3,
+        maxrss()
+    ))
+
+    # Converge from the synthetic state, applying each round's new actions
+    # as receivers would, ignoring those resent while in flight
+    previous = {}
+    for round in range(1, args.rounds + 1):
+        start = time.time()
+        actions = algorithm.schedule()
+        elapsed = time.time() - start
+        new = fresh(actions, previous)
+        print("round {:<3} {:>9.1f} ms  {:>7} actions  {:>7} resent".format(
+            round,
+            elapsed * 1e3,
+            count(new),
+            count(actions) - count(new)
+        ))
+        if not actions:
+            break
+        simulation.apply(new)
+        previous = actions
+
+    # Steady state passes after killing a few containers each time
+    latencies = []
+    totals = []
+    for _ in range(args.passes):
+        simulation.churn(args.churn)
+        start = time.time()
+        actions = algorithm.schedule()
+        latencies.append(time.time() - start)
+        new = fresh(actions, previous)
+        totals.append(count(new))
+        simulation.apply(new)
+        previous = actions
+
+    if latencies:
+        print("churn of {} over {} passes:".format(args.churn, args.passes))
+        for label, fraction in [("p50", 0.5), ("p90", 0.9), ("p99", 0.99)]:
+            print("  {}  {:>9.2f} ms".format(
+                label,
+                percentile(latencies, fraction) * 1e3
+            ))
+        print("  max  {:>9.2f} ms".format(max(latencies) * 1e3))
+        print("  actions per pass {:.1f}".format(
+            float(sum(totals)) / len(totals)
+        ))
+
+    print("peak memory {:.1f} MiB".format(maxrss()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import hashlib
 import hmac
 
 
@@ -6,11 +7,26 @@ class Auth():
 
     def __init__(self, key, data):
         # Store parameters
-        self._key = key
+        self._key = str(key)
         self._data = data
 
+        # Keyed HMAC states, copied per message rather than re-keyed
+        self._node_hmac = hmac.new(self._key)
+        self._payload_hmac = hmac.new(self._key, digestmod=hashlib.sha256)
+
+        # Digests we've already verified, by node
+        self._verified = {}
+
         # Compute this node's digest
-        self._digest = hmac.new(str(self._key), str(self._data)).hexdigest()
+        self._digest = self._hexdigest(self._node_hmac, str(self._data))
+
+    def _hexdigest(self, keyed, *parts):
+        """Return hex digest of parts using a copy of keyed HMAC state."""
+
+        mac = keyed.copy()
+        for part in parts:
+            mac.update(part)
+        return mac.hexdigest()
 
     def digest(self):
         """Get our digest."""
@@ -20,4 +36,34 @@ class Auth():
     def verify(self, digest, data):
         """Verify specified digest matches data with our key."""
 
-        return hmac.new(str(self._key), str(data)).hexdigest() == digest
+        data = str(data)
+
+        # Cheap path for senders we've seen before
+        known = self._verified.get(data)
+        if known is not None:
+            return hmac.compare_digest(known, str(digest))
+
+        # Otherwise compute, and remember it if it's good
+        if hmac.compare_digest(
+            self._hexdigest(self._node_hmac, data),
+            str(digest)
+        ):
+            self._verified[data] = str(digest)
+            return True
+
+        return False
+
+    def sign(self, *parts):
+        """Get SHA-256 HMAC of message parts, such as its frames."""
+
+        # Length-prefix each part so boundaries can't be shifted
+        framed = []
+        for part in parts:
+            framed.extend(["{}:".format(len(part)), part])
+
+        return self._hexdigest(self._payload_hmac, *framed)
+
+    def verify_signature(self, signature, *parts):
+        """Verify specified signature matches message parts."""
+
+        return hmac.compare_digest(self.sign(*parts), str(signature))
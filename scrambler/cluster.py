@@ -1,27 +1,37 @@
 from __future__ import print_function
 
 import Queue
-import time
+import threading
 import traceback
 
-from scrambler.store import Store
+from scrambler.detector import Detector
+from scrambler.election import Election
+from scrambler.store import SnapshotStore
 from scrambler.threads import Threads
+from scrambler.trace import Trace
 
 
 class Cluster():
     """Manage cluster discovery."""
 
-    def __init__(self, config, pubsub):
+    def __init__(self, config, pubsub, reactor=None):
         # Initialize from config
         self._hostname = config["hostname"]
         self._address = config["address"]
         self._announce_interval = config["interval"]["announce"]
 
+        # Most announcements per second each node should have to receive
+        self._budget = config["announce"]["budget"]
+
+        # Announce before the interval's up when our election view changes
+        self._wake = threading.Event()
+        self._announced = None
+
         # Store pubsub object
         self._pubsub = pubsub
 
         # Cluster state
-        self._state = Store(
+        self._state = SnapshotStore(
             {
                 self._hostname: {
                     "address": self._address,
@@ -30,27 +40,79 @@ class Cluster():
             }
         )
 
-        # Cluster message subscription queue
-        self._queue = self._pubsub.subscribe("cluster")
+        # Event loop to run on instead of threads, if any
+        self._reactor = reactor
+
+        # Cluster messages straight to the handler on the loop, or to a
+        # subscription queue
+        if self._reactor:
+            self._pubsub.subscribe("cluster", self.handle)
+        else:
+            self._queue = self._pubsub.subscribe("cluster")
+
+        # Callbacks for nodes that expire
+        self._expiry = []
+
+        # Leader election
+        self._election = Election(self._hostname)
+
+        # Failure detector fed by announcements
+        self._detector = Detector(
+            self.expire,
+            config["detector"]["threshold"],
+            config["detector"]["window"],
+            config["detector"]["min_std"],
+            config["detector"]["pause"],
+            self._announce_interval,
+            config["interval"]["zombie"]
+        )
 
-        # Start daemon worker threads
-        Threads([self.announce, self.listen])
+        # Announce on the loop, or start daemon worker threads
+        if self._reactor:
+            self._reactor.call_every(self.interval, self._announce)
+        else:
+            Threads([self.announce, self.listen])
 
     def get_state(self):
         """Just return state object."""
 
         return self._state
 
+    def on_expire(self, callback):
+        """Call callback(node, trace) when a node is declared dead, trace
+        timing what follows from detection on."""
+
+        self._expiry.append(callback)
+
+    def expire(self, node):
+        """Drop a node the failure detector gave up on."""
+
+        trace = Trace("detect")
+
+        # STONITH!!
+        self._election.leave(node)
+        self._elected()
+        if node in self._state:
+            del self._state[node]
+
+        for callback in self._expiry:
+            callback(node, trace)
+
     def is_master(self):
-        """Return true if there's only one master and we're it."""
+        """Return true if we're the elected master."""
+
+        return self._election.is_leader()
 
-        masters = [
-            key
-            for key in self._state.keys()
-            if self._state[key]["master"]
-        ]
+    def term(self):
+        """Return current election term, to stamp our actions with."""
 
-        return len(masters) == 1 and masters[0] == self._hostname
+        return self._election.term()
+
+    def current(self, node, term):
+        """Return true if actions from node stamped with term should be
+        followed."""
+
+        return self._election.current(node, term)
 
     def listen(self):
         """Handle cluster state messages."""
@@ -58,19 +120,13 @@ class Cluster():
         while True:
             try:
                 # Wait for cluster messages
-                key, node, data = self._queue.get(timeout=1)
+                key, node, data, trace = self._queue.get(timeout=1)
 
                 # Tell the queue we're done
                 self._queue.task_done()
 
-                # Timestamp message
-                data["timestamp"] = time.time()
-
-                # Update master status based on least lexical hostname
-                data["master"] = min(self._state.keys()) == node
-
-                # Store node:data
-                self._state.update({node: data})
+                # Handle it
+                self.handle(key, node, data, trace)
 
             # Catch empty queue timeout
             except Queue.Empty:
@@ -81,21 +137,84 @@ class Cluster():
                 print("Exception in cluster.listen():")
                 print(traceback.format_exc())
 
+    def handle(self, key, node, data, trace=None):
+        """Handle a cluster state message."""
+
+        # We're never a zombie, honest
+        if node != self._hostname:
+            self._detector.heartbeat(node, data.get("interval"))
+
+        # Track membership and terms for election
+        self._election.join(node)
+        self._election.observe(data.get("term", 0))
+        self._elected()
+
+        # Store node:data if it's news
+        if self._state.get(node) != data:
+            self._state.update({node: data})
+
+    def restore(self, state, term=0):
+        """Take on other nodes' state from a snapshot, as if they'd
+        announced it, and the highest election term it saw."""
+
+        self._election.observe(term)
+
+        for node, data in state.items():
+            if node != self._hostname:
+                self.handle("cluster", node, data)
+
+    def interval(self):
+        """Return how often to announce, backing off as the cluster grows
+        to keep the announcements each node receives within budget."""
+
+        return round(
+            max(
+                self._announce_interval,
+                float(len(self._state.snapshot())) / self._budget
+            ),
+            1
+        )
+
+    def _elected(self):
+        """Announce right away if our view of the election changed."""
+
+        elected = (self._election.is_leader(), self._election.term())
+
+        if elected != self._announced:
+            if self._reactor:
+                self._reactor.call_soon(self._announce)
+            else:
+                self._wake.set()
+
+    def _announce(self):
+        """Publish announcement with our state and view of election, and
+        how often to expect it."""
+
+        self._announced = (self._election.is_leader(), self._election.term())
+
+        self._pubsub.publish(
+            "cluster",
+            dict(
+                self._state[self._hostname],
+                master=self._announced[0],
+                term=self._announced[1],
+                interval=self.interval()
+            ),
+            loopback=True,
+            conflate="cluster"
+        )
+
     def announce(self):
         """Announce our state to the cluster."""
 
         while True:
             try:
-                # Publish announcement with our state
-                self._pubsub.publish(
-                    "cluster",
-                    self._state[self._hostname],
-                    loopback=True
-                )
+                self._wake.clear()
+                self._announce()
             # Print anything else and continue
             except:
                 print("Exception in cluster.announce():")
                 print(traceback.format_exc())
             finally:
-                # Wait the interval
-                time.sleep(self._announce_interval)
+                # Wait the interval, or for a change
+                self._wake.wait(self.interval())
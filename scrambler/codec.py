@@ -0,0 +1,90 @@
+import json
+import zlib
+
+# Optional compact binary encoding
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Codec():
+    """Provide pluggable message payload encoding.
+
+    Encoded payloads are described by a single header byte: the low bits
+    identify the encoding and the high bits mark zlib compression, payload
+    signing and a trailing trace frame, so receivers can decode anything
+    regardless of their own settings.
+    """
+
+    # Encoding identifiers
+    JSON = 0x00
+    MSGPACK = 0x01
+
+    # Header flags
+    COMPRESSED = 0x80
+    SIGNED = 0x40
+    TRACED = 0x20
+
+    # Mask to get the encoding from a header
+    MASK = 0x0f
+
+    def __init__(self, name="json", compress=0):
+        """Provide codec constructor.
+        name is the encoding to send with, "json" or "msgpack"
+        compress is the payload size from which to compress, 0 to disable
+        """
+
+        # Fall back to JSON if we can't do binary
+        if name == "msgpack" and msgpack is None:
+            print("msgpack unavailable, falling back to json codec")
+            name = "json"
+
+        # Store parameters
+        self._encoding = {"json": self.JSON, "msgpack": self.MSGPACK}[name]
+        self._compress = compress
+
+    def legacy(self):
+        """Return true if our payloads are plain JSON without a header."""
+
+        return self._encoding == self.JSON and not self._compress
+
+    def encode(self, data):
+        """Return (header, payload) for data."""
+
+        header = self._encoding
+
+        if header == self.MSGPACK:
+            payload = msgpack.packb(data, use_bin_type=False)
+        else:
+            payload = json.dumps(data, separators=(",", ":"))
+
+        # Only compress when it's likely to pay off
+        if self._compress and len(payload) >= self._compress:
+            payload = zlib.compress(payload)
+            header |= self.COMPRESSED
+
+        return chr(header), payload
+
+    def decode(self, header, payload):
+        """Return data for (header, payload), header None meaning legacy."""
+
+        # Legacy peers send bare JSON
+        if header is None:
+            return json.loads(payload)
+
+        header = ord(header)
+
+        if header & self.COMPRESSED:
+            payload = zlib.decompress(payload)
+
+        encoding = header & self.MASK
+
+        if encoding == self.JSON:
+            return json.loads(payload)
+        elif encoding == self.MSGPACK:
+            if msgpack is None:
+                raise ValueError("Can't decode msgpack payload")
+            return msgpack.unpackb(payload, raw=True)
+        else:
+            raise ValueError("Unknown encoding: {}".format(encoding))
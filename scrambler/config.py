@@ -1,44 +1,157 @@
+from __future__ import print_function
+
+import hashlib
 import json
+import os
+import threading
+import time
+import traceback
+
+from scrambler.threads import Threads
+
+
+class Frozen(dict):
+    """Provide immutable dict for config snapshots."""
+
+    def __reduce__(self):
+        return (Frozen, (dict(self),))
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Config is immutable")
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
 
-from scrambler.synchronized import synchronized
+
+def freeze(value):
+    """Return value with dicts frozen and lists made tuples, recursively."""
+
+    if isinstance(value, dict):
+        return Frozen((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
 
 
 class Config():
-    """Provide JSON config file object."""
+    """Provide JSON config file object.
+
+    Reads get an immutable snapshot without locking; reloading the file or
+    setting a key swaps in a new one, so nothing read can change under
+    the reader.
+    """
 
     def __init__(self, path="/usr/local/etc/scrambler/scrambler.json"):
-        # Store path to config and try to read it
+        # Store path to config
         self._path = path
+
+        # Keys set here rather than in the file, kept across reloads
+        self._overrides = {}
+
+        # File as last read: (mtime, size) stamp and content hash
+        self._stamp = None
+        self._hash = None
+
+        # Reload callbacks
+        self._callbacks = []
+
+        # Serializes reloads and sets
+        self._lock = threading.Lock()
+
+        # Try to read it
+        self._file = {}
+        self._config = Frozen()
         self.read()
 
-    @synchronized("write")
+    def _swap(self):
+        """Swap in a snapshot of the file with overrides, returning the old
+        one. Must be called with self._lock held."""
+
+        old = self._config
+        self._config = freeze(dict(self._file, **self._overrides))
+        return old
+
     def read(self):
-        """Parse that sucker."""
+        """Parse that sucker, returning (old, new) snapshots if it changed
+        since last read, or None if it didn't."""
+
+        with self._lock:
+            # Cheap check first
+            stat = os.stat(self._path)
+            stamp = (stat.st_mtime, stat.st_size)
+            if stamp == self._stamp:
+                return None
+
+            with open(self._path, "r") as fd:
+                content = fd.read()
+
+            # Touched but no different
+            digest = hashlib.sha1(content).hexdigest()
+            if digest == self._hash:
+                self._stamp = stamp
+                return None
+
+            # Parse before noting it read, so a half-written file is
+            # tried again next time
+            self._file = json.loads(content)
+            self._stamp = stamp
+            self._hash = digest
 
-        with open(self._path, "r") as fd:
-            self._config = json.load(fd)
+            return self._swap(), self._config
 
-    @synchronized("read")
     def write(self):
         """Write out our object."""
 
         with open(self._path, "w") as fd:
             json.dump(self._config, fd)
 
-    @synchronized("read")
+    def watch(self, interval, callback):
+        """Call callback(old, new) with the snapshots before and after each
+        change to the file, checking every interval seconds."""
+
+        with self._lock:
+            self._callbacks.append(callback)
+            if len(self._callbacks) > 1:
+                return
+
+        # Start daemon worker thread for the first
+        Threads([lambda: self.poll(interval)])
+
+    def poll(self, interval):
+        """Periodically reload the file if it changed."""
+
+        while True:
+            try:
+                changed = self.read()
+                if changed:
+                    print("[{}] Reloaded config".format(time.ctime()))
+                    for callback in self._callbacks:
+                        callback(*changed)
+            # Print anything else and continue
+            except:
+                print("Exception in config.poll():")
+                print(traceback.format_exc())
+            finally:
+                time.sleep(interval)
+
+    def snapshot(self):
+        """Return current immutable snapshot."""
+
+        return self._config
+
     def __contains__(self, key):
         """Check if object contains key."""
 
         return key in self._config
 
-    @synchronized("read")
     def __getitem__(self, key):
-        """Get a copy of the requested key's value or None if not found."""
+        """Get the requested key's value or None if not found."""
 
-        return self._config[key] if key in self._config else None
+        return self._config.get(key)
 
-    @synchronized("write")
     def __setitem__(self, key, value):
         """Push the new value in."""
 
-        self._config[key] = value
+        with self._lock:
+            self._overrides[key] = value
+            self._swap()
@@ -0,0 +1,207 @@
+from __future__ import print_function
+
+import collections
+import heapq
+import math
+import threading
+import time
+import traceback
+
+from scrambler.threads import Threads
+
+
+def phi(elapsed, mean, std):
+    """Return suspicion that a heartbeat elapsed seconds late is lost.
+
+    Uses a logistic approximation of the normal CDF of heartbeat
+    inter-arrival times; phi of 1 means a 10% chance the node is still
+    alive, 2 means 1%, and so on.
+    """
+
+    # Past ten deviations either way it's as good as certain
+    y = max(min((elapsed - mean) / std, 10.0), -10.0)
+    e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+    if elapsed > mean:
+        return -math.log10(e / (1.0 + e))
+    return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+
+class Detector():
+    """Provide phi-accrual failure detector.
+
+    Each node's heartbeat inter-arrival times give a mean and deviation,
+    from which the time its suspicion will reach the threshold is worked
+    out and kept in a heap, so expiry is prompt and costs O(log n) rather
+    than a scan of every node.
+    """
+
+    def __init__(
+        self,
+        callback,
+        threshold,
+        window,
+        min_std,
+        pause,
+        interval,
+        limit
+    ):
+        """Provide failure detector constructor.
+        callback is called with each node that expires
+        threshold is the phi at which a node is considered dead
+        window is the number of inter-arrival times to keep per node
+        min_std is the least deviation to assume, in seconds
+        pause is the number of heartbeat intervals a node may always go
+        silent for, however regular it's been
+        interval is the heartbeat interval to expect from nodes that don't
+        say, before we've seen any
+        limit is the longest a node beating at interval may go silent
+        regardless, in seconds
+        """
+
+        # Store parameters
+        self._callback = callback
+        self._window = window
+        self._min_std = min_std
+        self._pause = pause
+        self._interval = interval
+        self._limit = limit
+
+        # Deviations past the mean at which phi reaches threshold
+        self._deviations = self._solve(threshold)
+
+        # Per-node heartbeat history
+        self._nodes = {}
+
+        # (deadline, sequence, node) entries; stale ones are skipped
+        self._heap = []
+        self._sequence = 0
+
+        self._cond = threading.Condition(threading.Lock())
+
+        # Start daemon worker thread
+        Threads([self.watch])
+
+    def _solve(self, threshold):
+        """Return y for which phi(y, 0, 1) reaches threshold, by bisection."""
+
+        low, high = 0.0, 10.0
+        for _ in range(100):
+            middle = (low + high) / 2
+            if phi(middle, 0.0, 1.0) < threshold:
+                low = middle
+            else:
+                high = middle
+        return high
+
+    def _stats(self, history):
+        """Return (mean, std) of history's inter-arrival times."""
+
+        count = len(history["intervals"])
+        if not count:
+            return history["expected"], self._min_std
+
+        mean = history["sum"] / count
+        variance = max(history["squares"] / count - mean * mean, 0.0)
+        return mean, max(math.sqrt(variance), self._min_std)
+
+    def _schedule(self, node, history):
+        """Push node's next deadline. Must be called with self._cond held."""
+
+        # Never less than an acceptable pause, since a late heartbeat or a
+        # stall on our side shouldn't cost a node its containers
+        mean, std = self._stats(history)
+        timeout = max(
+            mean + self._deviations * std,
+            self._pause * history["expected"]
+        )
+
+        # Nodes beating slower than usual may go silent for longer
+        deadline = history["last"] + min(
+            timeout,
+            self._limit * max(float(history["expected"]) / self._interval, 1)
+        )
+
+        self._sequence += 1
+        history["sequence"] = self._sequence
+        heapq.heappush(self._heap, (deadline, self._sequence, node))
+
+        # Wake the watcher if this is now the earliest deadline
+        if self._heap[0][1] == self._sequence:
+            self._cond.notify()
+
+    def heartbeat(self, node, expected=None):
+        """Record heartbeat from node, optionally saying how often it beats."""
+
+        now = time.time()
+        expected = expected or self._interval
+
+        with self._cond:
+            history = self._nodes.get(node)
+
+            # New, or beating at a new rate, so what we knew no longer goes
+            if history is None or history["expected"] != expected:
+                history = self._nodes[node] = {
+                    "intervals": collections.deque(),
+                    "sum": 0.0,
+                    "squares": 0.0
+                }
+            else:
+                interval = now - history["last"]
+                history["intervals"].append(interval)
+                history["sum"] += interval
+                history["squares"] += interval * interval
+
+                if len(history["intervals"]) > self._window:
+                    interval = history["intervals"].popleft()
+                    history["sum"] -= interval
+                    history["squares"] -= interval * interval
+
+            history["last"] = now
+            history["expected"] = expected
+
+            self._schedule(node, history)
+
+    def forget(self, node):
+        """Stop tracking node."""
+
+        with self._cond:
+            self._nodes.pop(node, None)
+
+    def phi(self, node):
+        """Return node's current suspicion, or None if not tracked."""
+
+        with self._cond:
+            history = self._nodes.get(node)
+            if history is None:
+                return None
+            mean, std = self._stats(history)
+            return phi(time.time() - history["last"], mean, std)
+
+    def watch(self):
+        """Expire nodes as their deadlines pass."""
+
+        while True:
+            with self._cond:
+                # Wait for the earliest deadline
+                while not self._heap or self._heap[0][0] > time.time():
+                    if self._heap:
+                        self._cond.wait(self._heap[0][0] - time.time())
+                    else:
+                        self._cond.wait()
+
+                _, sequence, node = heapq.heappop(self._heap)
+
+                # Superseded by a later heartbeat, or forgotten
+                history = self._nodes.get(node)
+                if history is None or history["sequence"] != sequence:
+                    continue
+
+                del self._nodes[node]
+
+            # Tell someone, without holding the lock
+            try:
+                self._callback(node)
+            # Print anything else and continue
+            except:
+                print("Exception in detector.watch():")
+                print(traceback.format_exc())
@@ -1,82 +1,206 @@
 from __future__ import absolute_import  # When can 3.x be now?
 
+import collections
 import docker
+import functools
 import json
+import multiprocessing.pool
 import Queue
+import threading
 import time
 import traceback
+import uuid as uuidlib
 
-from scrambler.store import Store
+from scrambler.executor import Executor
+from scrambler.lease import Leases
+from scrambler.metrics import registry
+from scrambler.store import SnapshotStore, merge
 from scrambler.threads import Threads
 
 
 class Docker():
     """Provide local docker management."""
 
-    def __init__(self, config, pubsub):
+    def __init__(self, config, pubsub, cluster, reactor=None):
         # Store args
         self._config = config
         self._pubsub = pubsub
+        self._cluster = cluster
+        self._reactor = reactor
 
-        # Announce interval
+        # Announce and full checkpoint intervals, as backed off by the
+        # cluster as it grows
         self._announce_interval = self._config["interval"]["announce"]
+        self._checkpoint_interval = self._config["interval"]["checkpoint"]
+
+        # Announce changes right away rather than at the next interval
+        self._wake = threading.Event()
 
         # Store hostname
         self._hostname = self._config["hostname"]
 
-        # Docker subscription
-        self._docker_queue = self._pubsub.subscribe("docker")
-
-        # Schedule subscription
-        self._scheduled_queue = self._pubsub.subscribe("schedule")
+        # On the loop, peer state and schedules go straight to handlers,
+        # leaving the queue to local events that need docker calls
+        if self._reactor:
+            self._pubsub.subscribe("docker", self.handle)
+            self._docker_queue = Queue.Queue()
+            self._pubsub.subscribe("schedule", self.follow)
+        else:
+            # Docker subscription, folding announcements queued from each
+            # node together, but never resync requests or local events
+            self._docker_queue = self._pubsub.subscribe(
+                "docker",
+                conflate=lambda node, data: (
+                    None if data["type"] == "resync" else node
+                ),
+                merge=self._fold
+            )
+
+            # Schedule subscription
+            self._scheduled_queue = self._pubsub.subscribe("schedule")
 
         # Create client
         self._client = docker.Client()
 
-        # Docker state object
-        self._state = Store({self._hostname: self.containers_by_image()})
+        # Docker API call latencies
+        self._latency = registry.histogram(
+            "scrambler_docker_api_seconds",
+            "Docker API call latency by call"
+        )
+
+        # Bounded pool for parallel inspection
+        self._pool = multiprocessing.pool.ThreadPool(
+            self._config["docker"]["workers"]
+        )
+
+        # Scheduled action executor and per-action timeout
+        self._executor = Executor(
+            self._config["docker"]["actions"]["workers"],
+            self._config["docker"]["actions"]["per_image"]
+        )
+        self._action_timeout = self._config["docker"]["actions"]["timeout"]
+
+        # Actions in flight, so repeated schedules don't run them twice
+        self._leases = Leases(self._config["interval"]["lease"])
+
+        # Export executor stats
+        registry.gauge(
+            "scrambler_docker_actions",
+            "Scheduled actions by executor state or result",
+            lambda: dict(
+                ((("state", state),), value)
+                for state, value in self._executor.stats().items()
+            )
+        )
 
-        # Start daemon worker threads
-        Threads([self.scheduled, self.events, self.handler, self.announce])
+        # Docker state object
+        self._state = SnapshotStore(
+            {self._hostname: self.containers_by_image()}
+        )
+
+        # Guards local state changes and the pending delta
+        self._lock = threading.Lock()
+
+        # Our announcement stream: epoch changes on restart, version on change
+        self._epoch = uuidlib.uuid4().hex
+        self._version = 0
+
+        # Local changes since the last announced version
+        self._delta = {}
+
+        # Send a full checkpoint first, and again whenever one is requested
+        self._resync = True
+        self._checkpoint = 0
+
+        # Last applied (epoch, version) per remote node
+        self._versions = {}
+
+        # Last time we asked each remote node for a resync
+        self._requested = {}
+
+        # Traces of actions by container id, until events show the outcome
+        self._traced = {}
+
+        # Time of the last docker event seen, to resume the stream from,
+        # and counts of the events seen in that second, which resuming
+        # replays
+        self._since = None
+        self._seen = collections.Counter()
+
+        # Reconciliation interval
+        self._reconcile_interval = self._config["interval"]["reconcile"]
+
+        # Periodic work on the loop, and threads only for blocking calls
+        if self._reactor:
+            self._reactor.call_every(self._cluster.interval, self._announce)
+            self._reactor.call_every(
+                self._reconcile_interval,
+                lambda: self._docker_queue.put(
+                    ["reconcile", self._hostname, None, None]
+                )
+            )
+            Threads([self.events, self.handler])
+        # Or start daemon worker threads
+        else:
+            Threads(
+                [
+                    self.scheduled,
+                    self.events,
+                    self.handler,
+                    self.announce,
+                    self.reconcile
+                ]
+            )
 
     def get_state(self):
         """Just return state object."""
 
         return self._state
 
+    def _call(self, name, *args, **kwargs):
+        """Call docker client method by name, timing it."""
+
+        start = time.time()
+        try:
+            return getattr(self._client, name)(*args, **kwargs)
+        finally:
+            self._latency.observe(time.time() - start, call=name)
+
     def inspect_container(self, uuid):
         """Inspect and filter container by UUID."""
 
         # Get all container details
-        container = self._client.inspect_container(uuid)
+        container = self._call("inspect_container", uuid)
 
-        # Return dictionary of just what we want
-        return {
+        # Dictionary of just what we want
+        state = {
             "name": container["Name"],
             "state": container["State"]["Running"]
         }
 
+        return state
+
     def containers_by_image(self):
         """Return containers indexed by image name, then uuid."""
 
         # Build container (image, id) list
         info = [
             (container["Image"], container["Id"])
-            for container in self._client.containers()
+            for container in self._call("containers")
         ]
 
+        # Inspect them in parallel
+        states = self._pool.map(
+            self.inspect_container,
+            [uuid for _, uuid in info]
+        )
+
         # Initialize container list to return
         containers = {}
 
-        # For each (image, id) we found
-        for image, uuid in info:
-            # Initialize if first image
-            if not image in containers:
-                containers[image] = {uuid: {}}
-
-            # Inspect and store container state we care about
-            state = self.inspect_container(uuid)
-            containers[image][uuid] = state
+        # Store container state we care about by image
+        for (image, uuid), state in zip(info, states):
+            containers.setdefault(image, {})[uuid] = state
 
         # And return it
         return containers
@@ -87,55 +211,13 @@ class Docker():
         while True:
             try:
                 # Get message from queue
-                key, node, data = self._scheduled_queue.get(timeout=1)
+                key, node, data, trace = self._scheduled_queue.get(timeout=1)
 
                 # Let the queue know we got it
                 self._scheduled_queue.task_done()
 
-                # TODO: Pass in self._cluster_state and check node["master"]?
-
-                # Continue if no actions for us
-                if self._hostname not in data:
-                    continue
-
-                # Get our actions
-                actions = data[self._hostname]["actions"]
-
-                # For each scheduled action
-                for action in actions:
-                    # If we're told to run a container
-                    if action["do"] == "run":
-                        # Pull out config item
-                        config = action["config"]
-
-                        # Create an appropriate container
-                        container = self._client.create_container(
-                            image=action["image"],
-                            # TODO: Kill containers first to avoid collision?
-                            #name=action["name"],
-                            detach=True,
-                            ports=config["ports"].values()
-                        )
-
-                        # And start it
-                        self._client.start(
-                            container,
-                            port_bindings=config["ports"]
-                        )
-                    # Or if we're told to kill a container
-                    elif action["do"] == "die":
-                        # Nuke it
-                        self._client.kill(action["uuid"])
-                    # Any other actions
-                    else:
-                        print(
-                            "[{}] Unimplemented scheduled action "
-                            "from {}: {}".format(
-                                time.ctime(),
-                                node,
-                                action
-                            )
-                        )
+                # Follow them
+                self.follow(key, node, data, trace)
             # Continue on queue.get timeout
             except Queue.Empty:
                 continue
@@ -144,35 +226,403 @@ class Docker():
                 print("Exception in docker.scheduled():")
                 print(traceback.format_exc())
 
+    def follow(self, key, node, data, trace=None):
+        """Start scheduled actions meant for us."""
+
+        # Drop actions from anyone but the current master's term
+        if not self._cluster.current(node, data.get("term")):
+            print(
+                "[{}] Ignoring stale schedule from {}".format(
+                    time.ctime(),
+                    node
+                )
+            )
+            return
+
+        # Nothing for us
+        if self._hostname not in data["nodes"]:
+            return
+
+        # Get our actions
+        actions = data["nodes"][self._hostname]["actions"]
+
+        # Runs still in flight by image, which repeated actions in this
+        # schedule use up rather than starting more
+        starting = {}
+
+        # For each scheduled action
+        for action in actions:
+            # If we're told to run a container
+            if action["do"] == "run":
+                lease = ("run", action["image"])
+                func = self.run
+
+                if lease not in starting:
+                    starting[lease] = self._leases.count(lease)
+
+                # Already under way
+                if starting[lease]:
+                    starting[lease] -= 1
+                    continue
+            # Or if we're told to kill a container
+            elif action["do"] == "die":
+                lease = ("die", action["uuid"])
+                func = self.die
+
+                # Already under way
+                if self._leases.count(lease):
+                    continue
+            # Any other actions
+            else:
+                print(
+                    "[{}] Unimplemented scheduled action from {}: {}".format(
+                        time.ctime(),
+                        node,
+                        action
+                    )
+                )
+                continue
+
+            # In flight until docker events say it's done
+            self._leases.acquire(lease)
+
+            # Hand it to the executor, limited per image, with its own
+            # trace to carry on
+            self._executor.submit(
+                action.get("image"),
+                functools.partial(func, action, trace and trace.copy()),
+                self._action_timeout,
+                functools.partial(self.report, node, action, lease)
+            )
+
+    def run(self, action, trace=None):
+        """Create and start a container for a scheduled run action."""
+
+        if trace:
+            trace.mark("execute")
+
+        # Pull out config item
+        config = action["config"]
+
+        # Create an appropriate container
+        container = self._call(
+            "create_container",
+            image=action["image"],
+            # TODO: Kill containers first to avoid collision?
+            #name=action["name"],
+            detach=True,
+            ports=config["ports"].values()
+        )
+
+        # Its start event finishes the trace
+        if trace:
+            trace.mark("created")
+            self._traced[container["Id"]] = trace
+
+        # And start it
+        self._call(
+            "start",
+            container,
+            port_bindings=config["ports"]
+        )
+
+        if trace:
+            trace.mark("started")
+
+        return container
+
+    def die(self, action, trace=None):
+        """Kill the container of a scheduled die action."""
+
+        # Its die event finishes the trace
+        if trace:
+            trace.mark("execute")
+            self._traced[action["uuid"]] = trace
+
+        # Nuke it
+        self._call("kill", action["uuid"])
+
+        if trace:
+            trace.mark("killed")
+
+    def report(self, node, action, lease, status, result, elapsed):
+        """Report how a scheduled action went, if not well."""
+
+        # Never going to happen, so let it be scheduled again
+        if status in ["failed", "expired"]:
+            self._leases.release(lease)
+
+        if status != "ok":
+            print(
+                "[{}] Scheduled action from {} {} after {:.3f}s: {} {}".format(
+                    time.ctime(),
+                    node,
+                    status,
+                    elapsed,
+                    action,
+                    result if result is not None else ""
+                )
+            )
+
+    def _change(self, delta):
+        """Store and record local container changes, None meaning removed.
+
+        delta maps image to container id to state.
+        """
+
+        with self._lock:
+            self._state.merge_path([self._hostname], delta, 2)
+            for image, containers in delta.items():
+                self._delta.setdefault(image, {}).update(containers)
+
+        self._changed()
+
+    def _changed(self):
+        """Announce right away rather than at the next interval."""
+
+        if self._reactor:
+            self._reactor.call_soon(self._announce)
+        else:
+            self._wake.set()
+
+    def _announcement(self):
+        """Build next announcement: a delta, a full checkpoint or nothing."""
+
+        with self._lock:
+            now = time.time()
+
+            # Full checkpoint if requested or due, spaced out as much as
+            # heartbeats are
+            full = (
+                self._resync
+                or now - self._checkpoint >= (
+                    self._checkpoint_interval
+                    * self._cluster.interval()
+                    / self._announce_interval
+                )
+            )
+
+            # Nothing changed and no checkpoint due
+            if not full and not self._delta:
+                return None
+
+            # Every announcement gets a new version
+            self._version += 1
+            message = {
+                "epoch": self._epoch,
+                "version": self._version
+            }
+
+            # Checkpoints carry the whole state and supersede the delta
+            if full:
+                message["type"] = "full"
+                message["state"] = self._state[self._hostname]
+                self._resync = False
+                self._checkpoint = now
+            # Otherwise just the changes since the previous version
+            else:
+                message["type"] = "delta"
+                message["base"] = self._version - 1
+                message["delta"] = self._delta
+
+            self._delta = {}
+
+            return message
+
+    def _merge(self, old, new):
+        """Combine two queued announcements into one."""
+
+        # A checkpoint supersedes anything before it
+        if new["type"] == "full":
+            return new
+
+        # Fold a delta into a checkpoint
+        if old["type"] == "full":
+            return dict(
+                old,
+                version=new["version"],
+                state=merge(old["state"], new["delta"], 2)
+            )
+
+        # Two deltas span from the older base to the newer version
+        delta = dict(old["delta"])
+        for image, containers in new["delta"].items():
+            delta[image] = dict(delta.get(image, {}))
+            delta[image].update(containers)
+
+        return dict(new, base=old["base"], delta=delta)
+
+    def _fold(self, old, new):
+        """Combine two queued announcements received from a node into one."""
+
+        # Can't bridge a restart or a gap, so leave the newer to sort out
+        if old["epoch"] != new["epoch"] or (
+            new["type"] == "delta" and new["base"] > old["version"]
+        ):
+            return new
+
+        return self._merge(old, new)
+
+    def _request(self, node):
+        """Ask node for a full checkpoint, at most once per interval."""
+
+        now = time.time()
+
+        if now - self._requested.get(node, 0) >= self._announce_interval:
+            self._requested[node] = now
+            self._pubsub.publish("docker", {"type": "resync", "node": node})
+
+    def _receive(self, node, data):
+        """Apply a versioned state announcement from another node."""
+
+        # A node wants our full state
+        if data["type"] == "resync":
+            if data["node"] == self._hostname:
+                with self._lock:
+                    self._resync = True
+                self._changed()
+            return
+
+        # What we last applied from this node, if anything
+        known = self._versions.get(node)
+        current = (
+            known is not None
+            and known[0] == data["epoch"]
+            and node in self._state
+        )
+
+        # Full checkpoint replaces the node's state unless it's stale
+        if data["type"] == "full":
+            if current and data["version"] <= known[1]:
+                return
+
+            self._state.update({node: data["state"]})
+            self._versions[node] = (data["epoch"], data["version"])
+
+        # Deltas must start at or before what we have to be applicable
+        elif data["type"] == "delta":
+            # Missed something (or never heard of it), so ask for a resync
+            if not current or data["base"] > known[1]:
+                self._request(node)
+                return
+
+            # Already applied
+            if data["version"] <= known[1]:
+                return
+
+            # Apply it
+            self._state.merge_path([node], data["delta"], 2)
+            self._versions[node] = (data["epoch"], data["version"])
+
+    def _announce(self):
+        """Publish our state changes, if any."""
+
+        message = self._announcement()
+        if message:
+            self._pubsub.publish(
+                "docker",
+                message,
+                conflate="docker",
+                merge=self._merge
+            )
+
+    def snapshot(self):
+        """Return state of every node, and the version each reflects."""
+
+        with self._lock:
+            versions = dict(self._versions)
+            versions[self._hostname] = (self._epoch, self._version)
+            return {
+                "state": dict(self._state.snapshot()),
+                "versions": versions
+            }
+
+    def version(self, node):
+        """Return (epoch, version) of node's state we last applied."""
+
+        return self._versions.get(node)
+
+    def restore(self, snapshot, callback=None):
+        """Take on other nodes' state from a snapshot, where it's newer
+        than ours, calling callback() once it's applied."""
+
+        # Wherever announcements are applied, so they don't race
+        if self._reactor:
+            self._reactor.call_soon(self._restore, snapshot, callback)
+        else:
+            self._docker_queue.put(
+                ["snapshot", self._hostname, (snapshot, callback), None]
+            )
+
+    def _restore(self, snapshot, callback=None):
+        """Apply a snapshot."""
+
+        for node, (epoch, version) in snapshot["versions"].items():
+            # We know best about ourself
+            if node == self._hostname or node not in snapshot["state"]:
+                continue
+
+            # Already heard newer
+            known = self._versions.get(node)
+            if known and known[0] == epoch and known[1] >= version:
+                continue
+
+            # Deltas from here on apply on top of it
+            self._state.update({node: snapshot["state"][node]})
+            self._versions[node] = (epoch, version)
+
+        if callback:
+            callback()
+
     def announce(self):
-        """Periodically announce docker container state."""
+        """Periodically announce docker container state changes."""
 
         while True:
             try:
-                # Publish our container state
-                self._pubsub.publish("docker", self._state[self._hostname])
+                self._wake.clear()
+                self._announce()
             # Print anything else and continue
             except:
                 print("Exception in docker.announce():")
                 print(traceback.format_exc())
             finally:
-                # Wait the interval
-                time.sleep(self._announce_interval)
+                # Wait the interval, or for a change
+                self._wake.wait(self._cluster.interval())
 
     def events(self):
         """Push events from docker.events() to handler queue."""
 
         while True:
             try:
-                # Get events from local docker daemon
-                for event in self._client.events():
+                # Times are only to the second and resuming includes that
+                # second, so expect to be sent its events again
+                replayed = collections.Counter(self._seen)
+
+                # Get events from local docker daemon, resuming from the
+                # last one we saw so reconnects don't lose any
+                for event in self._client.events(since=self._since):
+                    event = json.loads(event)
+
+                    # Skip those we've already handled, lest a replayed
+                    # start release the lease of another run in flight
+                    seen = (
+                        event.get("id"),
+                        event.get("status"),
+                        event.get("time")
+                    )
+                    if replayed[seen]:
+                        replayed[seen] -= 1
+                        continue
+
+                    # Into a new second, forget the last one's
+                    if event.get("time", self._since) != self._since:
+                        self._since = event["time"]
+                        self._seen = collections.Counter()
+                    self._seen[seen] += 1
+
                     # And push to handler with "event" key
                     self._docker_queue.put(
-                        [
-                            "event",
-                            self._hostname,
-                            json.loads(event)
-                        ]
+                        ["event", self._hostname, event, None]
                     )
             # Print anything else and continue
             except:
@@ -180,47 +630,82 @@ class Docker():
                 print(traceback.format_exc())
                 # Don't spam if we're continuously failing
                 time.sleep(3)
+            # Catch anything the stream couldn't give us
+            finally:
+                self._docker_queue.put(
+                    ["reconcile", self._hostname, None, None]
+                )
+
+    def reconcile(self):
+        """Periodically have the handler reconcile state with docker."""
+
+        while True:
+            time.sleep(self._reconcile_interval)
+            self._docker_queue.put(
+                ["reconcile", self._hostname, None, None]
+            )
+
+    def _reconcile(self):
+        """Correct local state from docker's running container list.
+
+        Only containers that appeared or went away get inspected or
+        removed, so this is cheap when nothing drifted.
+        """
+
+        # What docker says is running
+        live = dict(
+            (container["Id"], container["Image"])
+            for container in self._call("containers")
+        )
+
+        # What we think is running
+        known = dict(
+            (uuid, image)
+            for image, containers in self._state[self._hostname].items()
+            for uuid, container in containers.items()
+            if container["state"]
+        )
+
+        delta = {}
+
+        # Gone, or stopped
+        for image, containers in self._state[self._hostname].items():
+            for uuid in containers:
+                if live.get(uuid) != image:
+                    delta.setdefault(image, {})[uuid] = None
+
+        # New, or running again
+        for uuid, image in live.items():
+            if known.get(uuid) != image:
+                delta.setdefault(image, {})[uuid] = (
+                    self.inspect_container(uuid)
+                )
+
+        if delta:
+            self._change(delta)
+
+        # Forget traces of actions we never heard the outcome of
+        stale = time.time() - self._reconcile_interval
+        for uuid, trace in self._traced.items():
+            if trace.last() < stale:
+                self._traced.pop(uuid, None)
 
     def handler(self):
         """Handle docker state messages and events."""
 
         while True:
             try:
-                # Get message from queue
-                key, node, data = self._docker_queue.get(timeout=1)
+                # Get message from queue, which on the loop only has local
+                # events, so can be waited on without polling
+                key, node, data, trace = self._docker_queue.get(
+                    timeout=None if self._reactor else 1
+                )
 
                 # Let the queue know we got it
                 self._docker_queue.task_done()
 
-                # If message is state transfer from other nodes
-                if key == "docker":
-                    # Update state for node
-                    self._state.update({node: data})
-
-                # If message is event stream from our listener
-                elif key == "event":
-                    # Grab image and id from event
-                    image = data["from"]
-                    uuid = data["id"]
-
-                    # If container has started
-                    if data["status"] == "start":
-                        # Inspect container and store it
-                        state = self.inspect_container(uuid)
-
-                        # If this is the first container for image
-                        if image not in self._state[self._hostname]:
-                            # Just store it
-                            self._state[self._hostname][image] = {uuid: state}
-                        # Otherwise add to the existing containers for image
-                        else:
-                            self._state[self._hostname][image][uuid] = state
-                    # If container has died
-                    elif data["status"] == "die":
-                        # Delete it from storage
-                        del self._state[self._hostname][image][uuid]
-                        if not self._state[self._hostname][image]:
-                            del self._state[self._hostname][image]
+                # Handle it
+                self.handle(key, node, data, trace)
             # Continue on queue.get timeout
             except Queue.Empty:
                 continue
@@ -228,3 +713,52 @@ class Docker():
             except:
                 print("Exception in docker.handler():")
                 print(traceback.format_exc())
+
+    def handle(self, key, node, data, trace=None):
+        """Handle a docker state message or event."""
+
+        # If message is state transfer from other nodes
+        if key == "docker":
+            # Apply checkpoint, delta or resync request
+            self._receive(node, data)
+
+        # If it's time to check we haven't drifted from docker
+        elif key == "reconcile":
+            self._reconcile()
+
+        # If a peer's snapshot came in
+        elif key == "snapshot":
+            self._restore(*data)
+
+        # If message is event stream from our listener
+        elif key == "event":
+            # Grab image and id from event
+            image = data["from"]
+            uuid = data["id"]
+
+            # If container has started
+            if data["status"] == "start":
+                # Inspect container
+                state = self.inspect_container(uuid)
+
+                # Store it and announce it with the next delta
+                self._change({image: {uuid: state}})
+
+                # A run for its image is no longer in flight
+                self._leases.release(("run", image))
+
+                # And if we ran it, that's as far as it goes
+                trace = self._traced.pop(uuid, None)
+                if trace:
+                    trace.mark("reflected")
+            # If container has died
+            elif data["status"] == "die":
+                # Delete it from storage and announce that
+                self._change({image: {uuid: None}})
+
+                # Nor is a die for it
+                self._leases.release(("die", uuid))
+
+                trace = self._traced.pop(uuid, None)
+                if trace:
+                    trace.mark("reflected")
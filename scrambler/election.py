@@ -0,0 +1,83 @@
+import threading
+
+
+class Election():
+    """Provide cached least-hostname leader election with terms.
+
+    The leader is kept up to date as nodes join and leave instead of being
+    recomputed from every node, and whenever we become leader we start a
+    term higher than any seen, so actions from a leader that has since
+    been superseded can be told apart and dropped.
+    """
+
+    def __init__(self, hostname):
+        # Store parameters
+        self._hostname = hostname
+
+        # Known nodes and the current leader
+        self._members = set([hostname])
+        self._leader = hostname
+
+        # Highest term seen, ours included
+        self._term = 1
+
+        self._lock = threading.Lock()
+
+    def _elect(self, leader):
+        """Set leader, starting a new term if it's us.
+
+        Must be called with self._lock held.
+        """
+
+        if leader != self._leader:
+            self._leader = leader
+            if leader == self._hostname:
+                self._term += 1
+
+    def join(self, node):
+        """Add node, which may take over as leader."""
+
+        with self._lock:
+            if node not in self._members:
+                self._members.add(node)
+                if node < self._leader:
+                    self._elect(node)
+
+    def leave(self, node):
+        """Remove node, electing another leader if it was the one."""
+
+        with self._lock:
+            self._members.discard(node)
+            if node == self._leader:
+                self._elect(min(self._members))
+
+    def observe(self, term):
+        """Note a term announced by another node."""
+
+        with self._lock:
+            self._term = max(self._term, term)
+
+    def leader(self):
+        """Return current leader."""
+
+        return self._leader
+
+    def is_leader(self):
+        """Return true if we're the leader."""
+
+        return self._leader == self._hostname
+
+    def term(self):
+        """Return highest term seen."""
+
+        return self._term
+
+    def current(self, node, term):
+        """Return true if node is the leader and term isn't superseded."""
+
+        with self._lock:
+            if node != self._leader or term is None or term < self._term:
+                return False
+
+            self._term = term
+            return True
@@ -0,0 +1,125 @@
+from __future__ import print_function
+
+import collections
+import Queue
+import threading
+import time
+import traceback
+
+from scrambler.threads import Threads
+
+
+class Executor():
+    """Provide worker pool running jobs with global and per-key limits.
+
+    At most workers jobs run at once, and at most per_key with the same
+    key; the rest wait their turn in order. Jobs that can't start before
+    their timeout are expired rather than run, and ones that run past it
+    are reported as timed out.
+    """
+
+    def __init__(self, workers, per_key):
+        # Store parameters
+        self._per_key = per_key
+
+        # Jobs ready to run
+        self._ready = Queue.Queue()
+
+        # Running job counts and jobs held back, by key
+        self._running = collections.defaultdict(int)
+        self._held = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+        # Results by status
+        self._results = collections.defaultdict(int)
+
+        # Start daemon worker threads
+        Threads([self.worker] * workers)
+
+    def submit(self, key, func, timeout, callback=None):
+        """Run func() when allowed, then callback(status, result, elapsed).
+
+        status is "ok", "failed", "timeout" or "expired", and result is
+        func's return value or the exception it raised.
+        """
+
+        job = {
+            "key": key,
+            "func": func,
+            "callback": callback,
+            "submitted": time.time(),
+            "deadline": time.time() + timeout
+        }
+
+        with self._lock:
+            if key is None or self._running[key] < self._per_key:
+                self._running[key] += 1
+                self._ready.put(job)
+            else:
+                self._held[key].append(job)
+
+    def stats(self):
+        """Return job counts: queued, held back, running and by result."""
+
+        with self._lock:
+            stats = dict(self._results)
+            stats.update(
+                {
+                    "ready": self._ready.qsize(),
+                    "held": sum(len(jobs) for jobs in self._held.values()),
+                    "running": sum(self._running.values())
+                }
+            )
+            return stats
+
+    def _release(self, key):
+        """Finish a job for key, letting the next one held back go."""
+
+        with self._lock:
+            if self._held[key]:
+                self._ready.put(self._held[key].popleft())
+            else:
+                self._running[key] -= 1
+                if not self._running[key]:
+                    del self._running[key]
+                del self._held[key]
+
+    def worker(self):
+        """Run ready jobs."""
+
+        while True:
+            job = self._ready.get()
+
+            result = None
+
+            try:
+                # Too late to bother
+                if time.time() > job["deadline"]:
+                    status = "expired"
+                else:
+                    result = job["func"]()
+                    status = (
+                        "ok"
+                        if time.time() <= job["deadline"]
+                        else "timeout"
+                    )
+            except Exception as error:
+                status = "failed"
+                result = error
+            finally:
+                self._release(job["key"])
+
+            with self._lock:
+                self._results[status] += 1
+
+            try:
+                if job["callback"]:
+                    job["callback"](
+                        status,
+                        result,
+                        time.time() - job["submitted"]
+                    )
+            # Print anything else and continue
+            except:
+                print("Exception in executor.worker():")
+                print(traceback.format_exc())
@@ -0,0 +1,219 @@
+from __future__ import print_function
+
+import errno
+import json
+import mmap
+import os
+import threading
+import time
+import traceback
+
+from scrambler.threads import Threads
+
+
+class Journal():
+    """Provide append-only on-disk journal of store contents.
+
+    Changed keys are gathered and written out as JSON lines once per
+    interval, so a busy key costs one record per interval however often
+    it changes, and the file is periodically compacted down to one record
+    per key. Loading it back gives a restarted agent a warm view of the
+    cluster to reconcile with live data, rather than starting blind.
+    """
+
+    def __init__(self, path, interval, compact):
+        """Provide journal constructor.
+        path is the journal file, created along with its directory
+        interval is how often to write changes out, in seconds
+        compact is how often to compact the file, in seconds
+        """
+
+        # Store parameters
+        self._path = path
+        self._interval = interval
+        self._compact = compact
+
+        # Tracked stores with their version functions, and polled values
+        self._stores = {}
+        self._polled = {}
+
+        # Keys changed since the last flush by store name, and values last
+        # written by name
+        self._dirty = {}
+        self._written = {}
+        self._lock = threading.Lock()
+
+        # Last compaction, none yet
+        self._compacted = 0
+
+        # Make somewhere to put it
+        try:
+            os.makedirs(os.path.dirname(self._path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self._fd = open(self._path, "a")
+
+    def load(self):
+        """Return (contents, versions) as of the last record written.
+
+        contents maps store name to key to value, or polled value name to
+        value; versions maps store name to key to version, where known.
+        """
+
+        contents = {}
+        versions = {}
+
+        with open(self._path, "rb") as fd:
+            # Nothing to map
+            if not os.fstat(fd.fileno()).st_size:
+                return contents, versions
+
+            journal = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            for line in iter(journal.readline, ""):
+                try:
+                    record = json.loads(line)
+                # Torn by a crash mid-write
+                except ValueError:
+                    continue
+
+                name = record["store"]
+
+                # Polled value
+                if "key" not in record:
+                    contents[name] = record["value"]
+                    continue
+
+                key = record["key"]
+                values = contents.setdefault(name, {})
+                known = versions.setdefault(name, {})
+
+                # Deleted
+                if record["value"] is None:
+                    values.pop(key, None)
+                    known.pop(key, None)
+                    continue
+
+                values[key] = record["value"]
+                if record.get("version"):
+                    known[key] = record["version"]
+                else:
+                    known.pop(key, None)
+        finally:
+            journal.close()
+
+        return contents, versions
+
+    def track(self, name, store, version=None):
+        """Journal changes to store under name, with version(key) if given.
+
+        Call after loading anything back into store, so that isn't
+        written out again.
+        """
+
+        self._stores[name] = (store, version)
+        store.watch(lambda keys: self._changed(name, keys))
+
+    def poll(self, name, func):
+        """Journal func()'s value under name whenever it changes."""
+
+        self._polled[name] = func
+
+    def start(self):
+        """Start writing changes out, compacting first."""
+
+        Threads([self.worker])
+
+    def _changed(self, name, keys):
+        """Note keys of store name changed."""
+
+        with self._lock:
+            self._dirty.setdefault(name, set()).update(keys)
+
+    def _record(self, name, key):
+        """Return record of key's current value in store name."""
+
+        store, version = self._stores[name]
+        record = {"store": name, "key": key}
+
+        # Version first, so the value's at least as new as it says
+        if version:
+            record["version"] = version(key)
+        record["value"] = store.get(key)
+
+        return record
+
+    def _write(self, fd, records):
+        """Write records to fd, one per line."""
+
+        for record in records:
+            fd.write(json.dumps(record, separators=(",", ":")) + "\n")
+        fd.flush()
+
+    def flush(self):
+        """Write out records of what changed since the last flush."""
+
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+
+        records = [
+            self._record(name, key)
+            for name, keys in dirty.items()
+            for key in keys
+        ]
+
+        for name, func in self._polled.items():
+            value = func()
+            if value != self._written.get(name):
+                self._written[name] = value
+                records.append({"store": name, "value": value})
+
+        self._write(self._fd, records)
+
+    def compact(self):
+        """Replace the journal with one record per key."""
+
+        records = [
+            self._record(name, key)
+            for name, (store, _) in self._stores.items()
+            for key in store.keys()
+        ]
+
+        for name, func in self._polled.items():
+            self._written[name] = func()
+            records.append({"store": name, "value": self._written[name]})
+
+        # Write it aside and swap it in whole
+        temporary = self._path + ".tmp"
+        with open(temporary, "w") as fd:
+            self._write(fd, records)
+            os.fsync(fd.fileno())
+        os.rename(temporary, self._path)
+
+        # Append to the new one from here on
+        self._fd.close()
+        self._fd = open(self._path, "a")
+
+        self._compacted = time.time()
+
+    def worker(self):
+        """Periodically write changes out and compact."""
+
+        while True:
+            try:
+                # Compact when due, which takes in any changes too
+                if time.time() - self._compacted >= self._compact:
+                    with self._lock:
+                        self._dirty = {}
+                    self.compact()
+                else:
+                    self.flush()
+            # Print anything else and continue
+            except:
+                print("Exception in journal.worker():")
+                print(traceback.format_exc())
+            finally:
+                time.sleep(self._interval)
@@ -0,0 +1,97 @@
+import threading
+import time
+
+
+class Leases():
+    """Provide expiring leases on in-flight actions.
+
+    A lease is taken when an action is issued and released once its effect
+    shows up in state, or expires after ttl seconds if it never does, so
+    the same action isn't issued again while it's still in flight. Keys are
+    tuples like ("run", image, node) or ("die", image, uuid), and a key
+    can hold several leases.
+    """
+
+    def __init__(self, ttl):
+        # Store parameters
+        self._ttl = ttl
+
+        # [expiry, node, action] entries by key, oldest first
+        self._leases = {}
+
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        """Drop expired leases. Must be called with self._lock held."""
+
+        now = time.time()
+
+        for key in self._leases.keys():
+            self._leases[key] = [
+                lease
+                for lease in self._leases[key]
+                if lease[0] > now
+            ]
+            if not self._leases[key]:
+                del self._leases[key]
+
+    def acquire(self, key, node=None, action=None):
+        """Take a lease on key for action on node."""
+
+        with self._lock:
+            self._leases.setdefault(key, []).append(
+                [time.time() + self._ttl, node, action]
+            )
+
+    def release(self, key, count=1):
+        """Release up to count of the oldest leases on key."""
+
+        with self._lock:
+            if key in self._leases:
+                del self._leases[key][:count]
+                if not self._leases[key]:
+                    del self._leases[key]
+
+    def count(self, key):
+        """Return number of live leases on key."""
+
+        with self._lock:
+            self._expire()
+            return len(self._leases.get(key, []))
+
+    def counts(self, kind, image):
+        """Return live lease counts by last key part for (kind, image)."""
+
+        with self._lock:
+            self._expire()
+            return dict(
+                (key[2], len(leases))
+                for key, leases in self._leases.items()
+                if key[:2] == (kind, image)
+            )
+
+    def settle(self, node, state):
+        """Release die leases on node whose containers are gone."""
+
+        with self._lock:
+            for key in self._leases.keys():
+                if (
+                    key[0] == "die"
+                    and self._leases[key][0][1] == node
+                    and key[2] not in (state or {}).get(key[1], {})
+                ):
+                    del self._leases[key]
+
+    def actions(self):
+        """Return live leased actions as a schedule."""
+
+        with self._lock:
+            self._expire()
+
+            schedule = {}
+            for leases in self._leases.values():
+                for _, node, action in leases:
+                    schedule.setdefault(node, {"actions": []})
+                    schedule[node]["actions"].append(action)
+
+            return schedule
@@ -1,3 +1,4 @@
+import collections
 import json
 import platform
 import socket
@@ -7,9 +8,16 @@ import traceback
 from scrambler.cluster import Cluster
 from scrambler.config import Config
 from scrambler.docker import Docker
+from scrambler.journal import Journal
+from scrambler.metrics import registry
+from scrambler.policy import Policies, diff
 from scrambler.pubsub import PubSub
+from scrambler.reactor import Reactor
+from scrambler import scheduler
+from scrambler.sync import Sync
 from scrambler.threads import Threads
-from scrambler.scheduler import Distribution
+from scrambler.trace import Trace
+from scrambler.trigger import Trigger
 
 
 class Manager():
@@ -24,7 +32,6 @@ class Manager():
             # Store intervals
             self._schedule_interval = self._config["interval"]["schedule"]
             self._update_interval = self._config["interval"]["update"]
-            self._zombie_interval = self._config["interval"]["zombie"]
 
             if "hostname" not in self._config:
                 # Get hostname
@@ -39,22 +46,127 @@ class Manager():
             # Store hostname
             self._hostname = self._config["hostname"]
 
-            # ZMQ PUB/SUB helper
-            self._pubsub = PubSub(self._config)
+            # Serve metrics locally
+            if self._config["metrics"]["port"]:
+                registry.serve(
+                    self._config["metrics"]["address"],
+                    self._config["metrics"]["port"]
+                )
 
-            # Initialize docker client and get state
-            self._docker = Docker(self._config, self._pubsub)
-            self._docker_state = self._docker.get_state()
+            # Scheduling metrics
+            self._duration = registry.histogram(
+                "scrambler_schedule_seconds",
+                "Scheduling pass duration"
+            )
+            self._actions = registry.counter(
+                "scrambler_schedule_actions_total",
+                "Scheduled actions published by kind, and whether new or "
+                "resent while in flight"
+            )
+
+            # Run everything on one event loop, or on threads of its own
+            if self._config["runtime"] == "reactor":
+                self._reactor = Reactor()
+            else:
+                self._reactor = None
+
+            # ZMQ PUB/SUB helper
+            self._pubsub = PubSub(self._config, self._reactor)
 
             # Initialize cluster and get state
-            self._cluster = Cluster(self._config, self._pubsub)
+            self._cluster = Cluster(self._config, self._pubsub, self._reactor)
             self._cluster_state = self._cluster.get_state()
 
-            # Start update thread
-            Threads([self.update])
+            # Initialize docker client, following the cluster's master,
+            # and get state
+            self._docker = Docker(
+                self._config,
+                self._pubsub,
+                self._cluster,
+                self._reactor
+            )
+            self._docker_state = self._docker.get_state()
+
+            # Warm up from what we knew before a restart, if journaled
+            self._journal = None
+            contents = {}
+            if self._config["journal"]["path"]:
+                contents = self.warm()
+
+            # Serve state snapshots to joining peers, and fetch our own
+            self._sync = Sync(
+                self._config,
+                self._cluster,
+                self._docker,
+                self._reactor
+            )
 
-            # Start scheduler thread and wait on it
-            Threads([self.schedule], join=True)
+            # Policies, as edited in config and agreed across the cluster
+            self._policies = Policies(
+                self._config,
+                self._pubsub,
+                self._reactor,
+                contents.get("policies")
+            )
+
+            # Journal from here on, policies included
+            if self._journal:
+                self._journal.poll("policies", self._policies.saved)
+                self._journal.start()
+
+            # Scheduler class named in config
+            policies = self._policies.get()
+            self._scheduler = getattr(scheduler, self._config["scheduler"])(
+                policies,
+                self._cluster_state,
+                self._docker_state,
+                self._config["interval"]["lease"]
+            )
+
+            # State snapshots last shown
+            self._shown = {}
+
+            # Traces of deaths not yet scheduled for
+            self._traces = collections.deque()
+
+            # Forget docker state of nodes that die
+            self._cluster.on_expire(self.expire)
+
+            # Schedule when docker state or cluster membership changes,
+            # starting right away
+            self._trigger = Trigger(
+                self._config["interval"]["debounce"],
+                self._config["interval"]["staleness"]
+            )
+            self._members = set(self._cluster_state.keys())
+            self._docker_state.watch(self.changed)
+            self._cluster_state.watch(self.membership)
+            self.changed()
+
+            # Follow policy changes, catching up on any adopted since the
+            # scheduler took them
+            self._policies.on_change(self.policies)
+            current = self._policies.get()
+            if current is not policies:
+                self.policies(current, set().union(*diff(policies, current)))
+
+            # Passes put off until we synced need doing once we are
+            self._sync.on_ready(self.changed)
+
+            # Run updates and scheduling on the loop, until interrupted
+            if self._reactor:
+                self._reactor.call_every(self._update_interval, self._update)
+                self._reactor.call_every(
+                    self._schedule_interval,
+                    self._schedule
+                )
+                self._reactor.run()
+            else:
+                # Start update thread
+                Threads([self.update])
+
+                # Start scheduler thread and wait on it
+                Threads([self.schedule], join=True)
 
         # Handle ^C
         except KeyboardInterrupt:
@@ -64,40 +176,68 @@ class Manager():
             print("Exiting due to exception:")
             print(traceback.format_exc())
 
+    def warm(self):
+        """Load state from the journal and track it, returning what was
+        loaded; the journal's started once everything's tracked.
+
+        Other nodes are taken on as if they'd just announced themselves,
+        so any that died since expire in due course, and their docker
+        state only where we know its version, so announcements carry on
+        from it or resync it.
+        """
+
+        # Only ever a head start, so not worth failing to start over
+        try:
+            self._journal = Journal(
+                self._config["journal"]["path"],
+                self._config["journal"]["interval"],
+                self._config["journal"]["compact"]
+            )
+        except (IOError, OSError) as e:
+            print(
+                "[{}] Running without a journal: {}".format(
+                    time.ctime(),
+                    e
+                )
+            )
+            self._journal = None
+            return {}
+
+        contents, versions = self._journal.load()
+
+        self._cluster.restore(
+            contents.get("cluster", {}),
+            contents.get("term", 0)
+        )
+        self._docker.restore(
+            {
+                "state": contents.get("docker", {}),
+                "versions": versions.get("docker", {})
+            }
+        )
+
+        self._journal.track("cluster", self._cluster_state)
+        self._journal.track("docker", self._docker_state, self._docker.version)
+        self._journal.poll("term", self._cluster.term)
+
+        return contents
+
+    def _update(self):
+        """Show what changed in states since we last did, if asked."""
+
+        if self._config["dump"]:
+            for name, state in [
+                ("Cluster", self._cluster_state),
+                ("Docker", self._docker_state)
+            ]:
+                self.dump(name, state.snapshot(), self._shown)
+
     def update(self):
         """Update states."""
 
         while True:
             try:
-                # Check for zombies and headshot them
-                for node, state in self._cluster_state:
-                    if (
-                        node != self._hostname  # We're never a zombie, honest
-                        and (
-                            time.time()
-                            - state["timestamp"]
-                            > self._zombie_interval
-                        )
-                    ):
-                        # STONITH!!
-                        del self._cluster_state[node]
-                        del self._docker_state[node]
-
-                # Show cluster state
-                print(
-                    "[{}] Cluster State: {}".format(
-                        time.ctime(),
-                        json.dumps(dict(self._cluster_state), indent=4)
-                    )
-                )
-
-                # Show docker state
-                print(
-                    "[{}] Docker State: {}".format(
-                        time.ctime(),
-                        json.dumps(dict(self._docker_state), indent=4)
-                    )
-                )
+                self._update()
             # Print anything else
             except:
                 print("Exception in manager.update()")
@@ -106,35 +246,136 @@ class Manager():
             finally:
                 time.sleep(self._update_interval)
 
-    def schedule(self):
-        """Schedule docker events based on policy."""
+    def expire(self, node, trace):
+        """Drop docker state of a dead node, tracing its replacement."""
+
+        self._traces.append(trace)
+
+        if node in self._docker_state:
+            del self._docker_state[node]
+
+    def dump(self, name, snapshot, shown):
+        """Print nodes changed or removed since the last snapshot shown."""
+
+        last = shown.get(name, {})
+        shown[name] = snapshot
 
-        #algorithm = self._config["scheduler"]
-        scheduler = Distribution(
-            self._config["policies"],
-            self._cluster_state,
-            self._docker_state
+        # Values are replaced rather than changed, so identity will do
+        changed = dict(
+            (node, state)
+            for node, state in snapshot.items()
+            if last.get(node) is not state
         )
+        removed = [node for node in last if node not in snapshot]
+
+        if changed or removed:
+            print(
+                "[{}] {} State changed: {} removed: {}".format(
+                    time.ctime(),
+                    name,
+                    json.dumps(changed, indent=4),
+                    removed
+                )
+            )
+
+    def membership(self, keys):
+        """Trigger scheduling if cluster nodes joined or left."""
+
+        if any(
+            (key in self._members) != (key in self._cluster_state)
+            for key in keys
+        ):
+            self._members = set(self._cluster_state.keys())
+            self.changed()
+
+    def policies(self, policies, images):
+        """Reschedule images whose policies changed."""
+
+        self._scheduler.set_policies(policies, images)
+        self.changed()
+
+    def changed(self, *args):
+        """Note a change to schedule for; accepts and ignores arguments to
+        suit callbacks."""
+
+        # The first change since the last schedule starts the loop
+        # waiting for them to settle
+        if self._trigger.fire() and self._reactor:
+            self._reactor.call_soon(self.settle)
+
+    def settle(self):
+        """Schedule once changes have settled, on the loop."""
+
+        settled, remaining = self._trigger.poll()
+
+        if settled:
+            self._schedule()
+        elif remaining is not None:
+            self._reactor.call_later(remaining, self.settle)
+
+    def schedule(self):
+        """Schedule docker events based on policy."""
 
         while True:
             try:
-                # If we're the only master
-                if self._cluster.is_master():
-                    # Schedule actions in accordance with policies
-                    actions = scheduler.schedule()
-
-                    # If actions required
-                    if actions:
-                        # Publish actions to everyone including ourself
-                        self._pubsub.publish(
-                            "schedule",
-                            actions,
-                            loopback=True
-                        )
+                # Wait for changes, but run at least every interval anyway
+                self._trigger.wait(self._schedule_interval)
+
+                self._schedule()
             # Print anything else and continue
             except:
                 print("Exception in manager.schedule():")
                 print(traceback.format_exc())
-            # Always wait the interval
-            finally:
-                time.sleep(self._schedule_interval)
+
+    def _schedule(self):
+        """Schedule actions in accordance with policies, if we're master."""
+
+        # Not until we've synced with the cluster, lest we act on a
+        # partial view of it; we're told when we are
+        if not self._sync.ready():
+            return
+
+        # Deaths since the last pass, the oldest of which is traced on
+        trace = None
+        while self._traces:
+            oldest = self._traces.popleft()
+            trace = trace or oldest
+
+        # If we're the elected master
+        if self._cluster.is_master():
+            # Schedule actions in accordance with policies
+            start = time.time()
+            actions = self._scheduler.schedule()
+            self._duration.observe(time.time() - start)
+
+            # Actions in flight are sent again each pass, so tell them apart
+            new = set(
+                id(action)
+                for node in self._scheduler.new().values()
+                for action in node["actions"]
+            )
+            for node in actions.values():
+                for action in node["actions"]:
+                    self._actions.inc(
+                        do=action["do"],
+                        sent="new" if id(action) in new else "resent"
+                    )
+
+            # If actions required
+            if actions:
+                # Trace them from here if no death led to them
+                trace = trace or Trace()
+                trace.mark("schedule")
+
+                # Publish actions to everyone including ourself, stamped
+                # with our term so they can tell we're still master
+                self._pubsub.publish(
+                    "schedule",
+                    {
+                        "term": self._cluster.term(),
+                        "nodes": actions
+                    },
+                    loopback=True,
+                    conflate="schedule",
+                    trace=trace
+                )
@@ -0,0 +1,208 @@
+from __future__ import print_function
+
+import BaseHTTPServer
+import bisect
+import threading
+import traceback
+
+from scrambler.threads import Threads
+
+
+class Metric():
+    """Provide base for labelled metrics."""
+
+    def __init__(self, name, help):
+        # Store parameters
+        self.name = name
+        self.help = help
+
+        # Values by sorted label tuples
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _labels(self, labels):
+        """Return hashable key for labels."""
+
+        return tuple(sorted(labels.items()))
+
+    def _format(self, labels, extra=()):
+        """Return labels in exposition format."""
+
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(
+            '{}="{}"'.format(key, str(value).replace('"', '\\"'))
+            for key, value in labels
+        ) + "}"
+
+
+class Counter(Metric):
+    """Provide monotonically increasing counter."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [
+                (self.name + self._format(labels), value)
+                for labels, value in sorted(self._values.items())
+            ]
+
+
+class Gauge(Metric):
+    """Provide gauge read from a callback returning {labels: value}.
+
+    labels are dicts given as sorted item tuples, or () for none.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, func):
+        Metric.__init__(self, name, help)
+        self._func = func
+
+    def samples(self):
+        return [
+            (self.name + self._format(labels), value)
+            for labels, value in sorted(self._func().items())
+        ]
+
+
+class Histogram(Metric):
+    """Provide histogram of observed values in cumulative buckets."""
+
+    kind = "histogram"
+
+    # Seconds, from a millisecond to a minute
+    BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]
+
+    def __init__(self, name, help, buckets=None):
+        Metric.__init__(self, name, help)
+        self._buckets = buckets or self.BUCKETS
+
+    def observe(self, value, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self._buckets), 0, 0]
+            counts, _, _ = entry = self._values[key]
+
+            # Count it in the first bucket it fits, cumulated on output
+            index = bisect.bisect_left(self._buckets, value)
+            if index < len(counts):
+                counts[index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, hits in zip(self._buckets, counts):
+                    cumulative += hits
+                    samples.append(
+                        (
+                            self.name + "_bucket" + self._format(
+                                labels,
+                                [("le", bound)]
+                            ),
+                            cumulative
+                        )
+                    )
+                samples.extend(
+                    [
+                        (
+                            self.name + "_bucket" + self._format(
+                                labels,
+                                [("le", "+Inf")]
+                            ),
+                            count
+                        ),
+                        (self.name + "_sum" + self._format(labels), total),
+                        (self.name + "_count" + self._format(labels), count)
+                    ]
+                )
+        return samples
+
+
+class Metrics():
+    """Provide registry of metrics, servable over HTTP."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        """Register metric, or return the one already under its name."""
+
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def histogram(self, name, help, buckets=None):
+        return self._register(Histogram(name, help, buckets))
+
+    def gauge(self, name, help, func):
+        """Register gauge, replacing any callback already under name."""
+
+        gauge = Gauge(name, help, func)
+        with self._lock:
+            self._metrics[name] = gauge
+        return gauge
+
+    def render(self):
+        """Return all metrics in Prometheus text exposition format."""
+
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+
+        lines = []
+        for name, metric in metrics:
+            try:
+                samples = metric.samples()
+            # A broken gauge callback shouldn't take the rest down
+            except:
+                print("Exception in metrics.render():")
+                print(traceback.format_exc())
+                continue
+
+            lines.append("# HELP {} {}".format(name, metric.help))
+            lines.append("# TYPE {} {}".format(name, metric.kind))
+            for sample, value in samples:
+                lines.append("{} {}".format(sample, value))
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, address, port):
+        """Serve metrics over HTTP from a daemon thread."""
+
+        registry = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((address, port), Handler)
+        Threads([server.serve_forever])
+        return server
+
+
+# Process-wide registry
+registry = Metrics()
@@ -0,0 +1,189 @@
+from __future__ import print_function
+
+import Queue
+import threading
+import time
+import traceback
+
+from scrambler.config import freeze
+from scrambler.threads import Threads
+
+
+def diff(old, new):
+    """Return (added, removed, changed) images between two policy sets."""
+
+    added = set(new) - set(old)
+    removed = set(old) - set(new)
+    changed = set(
+        image
+        for image in set(old) & set(new)
+        if old[image] != new[image]
+    )
+
+    return added, removed, changed
+
+
+class Policies():
+    """Provide cluster-wide versioned container policies.
+
+    Editing the config file gives its policies a version above any seen,
+    and they're announced to the cluster; nodes take on whichever version
+    is highest, ties going to the greater hostname, so everyone converges
+    on the latest edit without restarting. Given what was saved() last
+    run, edits made while we were down count too.
+    """
+
+    def __init__(self, config, pubsub, reactor=None, saved=None):
+        # Store config items
+        self._hostname = config["hostname"]
+        self._interval = config["interval"]["checkpoint"]
+
+        # Store args
+        self._pubsub = pubsub
+        self._reactor = reactor
+
+        # Policies as in the config file, current policies and their
+        # [counter, hostname] version
+        self._file = config["policies"]
+        self._policies = self._file
+        self._version = [0, self._hostname]
+        self._lock = threading.Lock()
+
+        # Carry on from last run, unless the file was edited since
+        if saved:
+            if freeze(saved["file"]) == self._file:
+                self._policies = freeze(saved["policies"])
+                self._version = list(saved["version"])
+            else:
+                self._version = [saved["version"][0] + 1, self._hostname]
+
+        # Change callbacks
+        self._callbacks = []
+
+        # Policy messages straight to the handler on the loop, or to a
+        # subscription queue
+        if self._reactor:
+            self._pubsub.subscribe("policy", self.handle)
+            self._reactor.call_every(self._interval, self._announce)
+        else:
+            self._queue = self._pubsub.subscribe("policy")
+            Threads([self.announce, self.listen])
+
+        # Pick up edits
+        config.watch(config["interval"]["config"], self.reloaded)
+
+    def get(self):
+        """Return current policies."""
+
+        return self._policies
+
+    def saved(self):
+        """Return what to carry on from next run."""
+
+        with self._lock:
+            return {
+                "version": self._version,
+                "policies": self._policies,
+                "file": self._file
+            }
+
+    def on_change(self, callback):
+        """Call callback(policies, images) with new policies and the images
+        whose policies were added, removed or changed."""
+
+        self._callbacks.append(callback)
+
+    def _adopt(self, policies, version):
+        """Take on policies at version, if it's newer. Must be called with
+        self._lock held."""
+
+        if version <= self._version:
+            return False
+
+        added, removed, changed = diff(self._policies, policies)
+
+        self._policies = policies
+        self._version = version
+
+        print(
+            "[{}] Policies version {} "
+            "added: {} removed: {} changed: {}".format(
+                time.ctime(),
+                version,
+                sorted(added),
+                sorted(removed),
+                sorted(changed)
+            )
+        )
+
+        for callback in self._callbacks:
+            callback(policies, added | removed | changed)
+
+        return True
+
+    def reloaded(self, old, new):
+        """Supersede policies with any edited into the config file."""
+
+        with self._lock:
+            if new["policies"] == old["policies"]:
+                return
+
+            self._file = new["policies"]
+
+            adopted = self._adopt(
+                new["policies"],
+                [self._version[0] + 1, self._hostname]
+            )
+
+        # Tell everyone
+        if adopted:
+            self._announce()
+
+    def handle(self, key, node, data, trace=None):
+        """Take on policies announced by another node, if newer."""
+
+        with self._lock:
+            self._adopt(freeze(data["policies"]), list(data["version"]))
+
+    def _announce(self):
+        """Publish current policies and version."""
+
+        with self._lock:
+            message = {"version": self._version, "policies": self._policies}
+
+        self._pubsub.publish("policy", message, conflate="policy")
+
+    def announce(self):
+        """Periodically announce policies, for anyone who missed them."""
+
+        while True:
+            try:
+                self._announce()
+            # Print anything else and continue
+            except:
+                print("Exception in policy.announce():")
+                print(traceback.format_exc())
+            finally:
+                # Wait the interval
+                time.sleep(self._interval)
+
+    def listen(self):
+        """Handle policy messages."""
+
+        while True:
+            try:
+                # Wait for policy messages
+                key, node, data, trace = self._queue.get(timeout=1)
+
+                # Tell the queue we're done
+                self._queue.task_done()
+
+                # Handle it
+                self.handle(key, node, data, trace)
+            # Continue on queue.get timeout
+            except Queue.Empty:
+                continue
+            # Print anything else and continue
+            except:
+                print("Exception in policy.listen():")
+                print(traceback.format_exc())
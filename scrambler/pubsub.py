@@ -1,4 +1,3 @@
-import json
 import threading
 import Queue
 import time
@@ -6,13 +5,22 @@ import traceback
 import zmq
 
 from scrambler.auth import Auth
+from scrambler.codec import Codec
+from scrambler.metrics import registry
+from scrambler.queues import ConflatingQueue
 from scrambler.store import Store
+from scrambler.trace import Trace
 
 
 class PubSub():
-    """Provide PUB/SUB interface."""
+    """Provide PUB/SUB interface.
 
-    def __init__(self, config):
+    Runs its own worker threads, or if given a reactor, sends and receives
+    on the reactor's loop and hands messages straight to subscriber
+    callbacks.
+    """
+
+    def __init__(self, config, reactor=None):
         # Store config items
         self._hostname = config["hostname"]
         self._group = config["connection"]["group"]
@@ -20,6 +28,8 @@ class PubSub():
         self._interface = config["connection"]["interface"]
         self._protocol = config["connection"]["protocol"]
         self._cluster_key = config["auth"]["cluster_key"]
+        self._sign = config["auth"]["sign"]
+        self._trace = config["trace"]
 
         # Build connection string
         self._connection = "{}://{}{}:{}".format(
@@ -29,10 +39,34 @@ class PubSub():
             self._port
         )
 
+        # Payload codec
+        self._codec = Codec(
+            config["codec"]["name"],
+            config["codec"]["compress"]
+        )
+
+        # Signing and tracing need the codec header, so only send legacy
+        # frames without
+        self._legacy = self._codec.legacy() and not (self._sign or self._trace)
+
         # Auth object
         self._auth = Auth(self._cluster_key, self._hostname)
         self._digest = self._auth.digest()
 
+        # Message metrics
+        self._messages = registry.counter(
+            "scrambler_pubsub_messages_total",
+            "PubSub messages by key and direction"
+        )
+        self._bytes = registry.counter(
+            "scrambler_pubsub_bytes_total",
+            "PubSub payload bytes by key and direction"
+        )
+        self._failures = registry.counter(
+            "scrambler_auth_failures_total",
+            "Received messages failing authentication by key"
+        )
+
         # Create ZMQ context
         self._context = zmq.Context()
 
@@ -57,63 +91,285 @@ class PubSub():
         self._pub.connect(self._connection)
         self._sub.connect(self._connection)
 
-        # pub/sub queues
+        # pub/sub queues, how to conflate what's queued for each, and
+        # callbacks subscribed in place of queues
         self._subscribers = Store()
-        self._publisher = Queue.Queue()
+        self._conflation = Store()
+        self._callbacks = Store()
+
+        # Subscriber queue bounds and overflow policies, by key or default
+        self._queues = config["queues"]
+        self._publisher = ConflatingQueue(
+            config["queues"]["publisher"]["size"]
+        )
 
-        # Create and start daemon worker threads
-        for target in [self.pub_worker, self.sub_worker]:
-            thread = threading.Thread(target=target)
-            thread.daemon = True
-            thread.start()
+        # Most messages to send per publisher wakeup
+        self._batch = config["queues"]["publisher"]["batch"]
 
-    def subscribe(self, key):
-        """Subscribe to key, create/return attached subscriber queue."""
+        # Export queue depths and counters
+        registry.gauge(
+            "scrambler_pubsub_queue_depth",
+            "Messages waiting in publisher and subscriber queues",
+            self.depths
+        )
+        registry.gauge(
+            "scrambler_pubsub_queue",
+            "Publisher and subscriber queue high water marks, and messages "
+            "conflated or dropped",
+            lambda: dict(
+                ((("queue", queue), ("stat", stat)), value)
+                for queue, stats in self.stats().items()
+                for stat, value in stats.items()
+                if stat != "depth"
+            )
+        )
+
+        # Event loop to run on instead of threads, if any
+        self._reactor = reactor
+        self._flushing = False
+
+        # Receive as soon as there's anything to on the loop
+        if self._reactor:
+            self._reactor.register(self._sub, self.readable)
+        # Or create and start daemon worker threads
+        else:
+            for target in [self.pub_worker, self.sub_worker]:
+                thread = threading.Thread(target=target)
+                thread.daemon = True
+                thread.start()
+
+    def subscribe(self, key, callback=None, conflate=None, merge=None):
+        """Subscribe to key, create/return attached subscriber queue.
+
+        Messages are [key, node, data, trace], trace being None unless the
+        sender traced it. If callback is given, it's called with each
+        message instead of queueing it, on whichever thread receives it.
+
+        The queue is bounded and overflows as configured for key, or for
+        subscribers in general: "block" the receiver for at most wait
+        seconds and then drop the oldest message, since receiving is
+        shared by every key, "drop" the oldest message right away, or
+        "conflate" each message with the one queued from the same sender,
+        dropping the oldest only when still full. conflate is called as
+        conflate(node, data) to give the key to conflate by instead of the
+        sender, None for a message that mustn't be, and merge as
+        merge(old, new) to combine conflated data rather than keep only
+        the newest.
+        """
 
         self._sub.setsockopt(zmq.SUBSCRIBE, key)
-        self._subscribers[key] = Queue.Queue()
+
+        if callback:
+            self._callbacks[key] = callback
+            return None
+
+        config = self._queues.get(key, self._queues["subscriber"])
+
+        self._conflation[key] = (
+            config["overflow"] == "conflate",
+            conflate or (lambda node, data: node),
+            merge
+        )
+        self._subscribers[key] = ConflatingQueue(
+            config["size"],
+            "block" if config["overflow"] == "block" else "drop",
+            config.get("wait", 0.1)
+        )
         return self._subscribers[key]
 
-    def publish(self, key, data, loopback=False):
-        """Publish message through publisher queue."""
+    def _deliver(self, key, node, data, trace):
+        """Hand message to its subscriber."""
+
+        if trace:
+            trace.mark("receive")
+
+        if key in self._callbacks:
+            self._callbacks[key](key, node, data, trace)
+            return
+
+        conflating, conflate, merge = self._conflation[key]
 
-        self._publisher.put([key, data, loopback])
+        self._subscribers[key].put(
+            [key, node, data, trace],
+            conflate(node, data) if conflating else None,
+            merge and (
+                lambda old, new: [
+                    key,
+                    node,
+                    merge(old[2], new[2]),
+                    old[3] or new[3]
+                ]
+            )
+        )
+
+    def publish(
+        self,
+        key,
+        data,
+        loopback=False,
+        conflate=None,
+        merge=None,
+        trace=None
+    ):
+        """Publish message through publisher queue.
+
+        Messages with the same conflate key replace each other while
+        queued, or are combined by merge(old, new) if given, keeping the
+        older trace. Traces are only sent to other nodes if enabled.
+        """
+
+        if trace:
+            trace.mark("publish")
+
+        self._publisher.put(
+            [key, data, loopback, trace],
+            conflate,
+            merge and (
+                lambda old, new: [
+                    key,
+                    merge(old[1], new[1]),
+                    loopback,
+                    old[3] or new[3]
+                ]
+            )
+        )
+
+        # Have the loop send it, unless it's already going to
+        if self._reactor and not self._flushing:
+            self._flushing = True
+            self._reactor.call_soon(self.flush)
+
+    def stats(self):
+        """Return publisher and subscriber queue depths and counters."""
+
+        stats = {"publisher": self._publisher.stats()}
+        for key, queue in self._subscribers.items():
+            stats[key] = queue.stats()
+        return stats
+
+    def depths(self):
+        """Return queue depths by queue label."""
+
+        depths = {(("queue", "publisher"),): self._publisher.qsize()}
+        for key, queue in self._subscribers.items():
+            depths[(("queue", key),)] = queue.qsize()
+        return depths
 
     def pub_worker(self):
         """Publish queued messages."""
 
         while True:
             try:
-                # Wait for message from queue
-                key, data, loopback = self._publisher.get(timeout=1)
-
-                # Let the queue know we got it
-                self._publisher.task_done()
-
-                # If we're sending it to ourself also
-                if loopback:
-                    # And there's a subscriber
-                    if key in self._subscribers:
-                        # Just push it to the subscriber queue
-                        self._subscribers[key].put([key, self._hostname, data])
-
-                # Publish it out
-                self._pub.send_multipart(
-                    [
-                        key,
-                        self._hostname,
-                        self._digest,
-                        json.dumps(data)
-                    ]
-                )
+                # Wait for messages from queue
+                messages = self._publisher.get_batch(self._batch, timeout=1)
             # Queue.get timed out, carry on
             except Queue.Empty:
                 continue
+
+            # Send them out as a burst
+            self._burst(messages)
+
+    def flush(self):
+        """Publish everything queued, on the reactor loop."""
+
+        # Cleared first, so anything published from here on gets another
+        # flush rather than being missed
+        self._flushing = False
+
+        while True:
+            try:
+                messages = self._publisher.get_batch(self._batch, False)
+            except Queue.Empty:
+                return
+
+            self._burst(messages)
+
+    def _burst(self, messages):
+        """Send messages, carrying on past any that fail."""
+
+        for message in messages:
+            try:
+                self._send(*message)
             # Print anything else and continue
             except:
-                print("Exception in pubsub.pub_worker():")
+                print("Exception in pubsub._burst():")
                 print(traceback.format_exc())
 
+    def _send(self, key, data, loopback, trace):
+        """Send a message out, and to ourself if asked."""
+
+        if trace:
+            trace.mark("send")
+
+        # If we're sending it to ourself also
+        if loopback:
+            # And there's a subscriber
+            if key in self._subscribers or key in self._callbacks:
+                # Just hand it over, with its own trace to carry on
+                self._deliver(
+                    key,
+                    self._hostname,
+                    data,
+                    trace and trace.copy()
+                )
+
+        # Encode payload
+        header, payload = self._codec.encode(data)
+
+        # Trace frame follows the payload, if we're sending one
+        extra = []
+        if trace and self._trace:
+            header = chr(ord(header) | Codec.TRACED)
+            extra = [trace.encode()]
+
+        # Legacy peers expect a bare JSON payload
+        if self._legacy:
+            frames = [key, self._hostname, self._digest, payload]
+        # Sign the whole message in place of our digest
+        elif self._sign:
+            header = chr(ord(header) | Codec.SIGNED)
+            frames = [
+                key,
+                self._hostname,
+                self._auth.sign(key, self._hostname, header, payload, *extra),
+                header,
+                payload
+            ] + extra
+        # Otherwise prefix payload with the codec header
+        else:
+            frames = [key, self._hostname, self._digest, header, payload]
+            frames += extra
+
+        # Publish it out
+        self._pub.send_multipart(frames)
+
+        self._messages.inc(key=key, direction="sent")
+        self._bytes.inc(len(payload), key=key, direction="sent")
+
+    def verify(self, key, node, digest, header, payload, *extra):
+        """Authenticate received message by signature or node digest.
+
+        If we sign, so must everyone else: the node digest never changes,
+        so anyone who's sniffed one could send unsigned messages as that
+        node, legacy frames included.
+        """
+
+        if header is not None and ord(header) & Codec.SIGNED:
+            return self._auth.verify_signature(
+                digest,
+                key,
+                node,
+                header,
+                payload,
+                *extra
+            )
+
+        # Unsigned, or legacy without a header to say
+        if self._sign:
+            return False
+
+        return self._auth.verify(digest, node)
+
     def sub_worker(self):
         """Queue subscribed messages we receive."""
 
@@ -126,28 +382,62 @@ class PubSub():
                 # Wait for message
                 sockets = dict(poller.poll(1000))  # In ms
 
-                # Got a message?
+                # Got a message? Receive it
                 if self._sub in sockets:
-                    # Receive it
-                    key, node, digest, data = self._sub.recv_multipart()
-
-                    # Convert to object
-                    data = json.loads(data)
-
-                    # If we have a subscriber
-                    if key in self._subscribers:
-                        # If authenticated, queue it
-                        if self._auth.verify(digest, node):
-                            self._subscribers[key].put([key, node, data])
-                        # Otherwise complain
-                        else:
-                            print(
-                                "[{}] Unauthenticated message: {}".format(
-                                    time.ctime(),
-                                    [key, node, json.dumps(data, indent=4)]
-                                )
-                            )
+                    self._receive(self._sub.recv_multipart())
             # Print anything else and continue
             except:
                 print("Exception in pubsub.sub_worker():")
                 print(traceback.format_exc())
+
+    def readable(self, socket):
+        """Receive everything waiting, on the reactor loop."""
+
+        while True:
+            try:
+                frames = socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+
+            try:
+                self._receive(frames)
+            # Print anything else and continue
+            except:
+                print("Exception in pubsub.readable():")
+                print(traceback.format_exc())
+
+    def _receive(self, frames):
+        """Authenticate, decode and deliver a received message."""
+
+        # Legacy peers don't send a codec header
+        if len(frames) == 4:
+            key, node, digest, payload = frames
+            header = None
+        else:
+            key, node, digest, header, payload = frames[:5]
+
+        # Anything after the payload, like a trace
+        extra = frames[5:]
+
+        self._messages.inc(key=key, direction="received")
+        self._bytes.inc(len(payload), key=key, direction="received")
+
+        # If we have a subscriber
+        if key in self._subscribers or key in self._callbacks:
+            # If authenticated, decode and deliver it
+            if self.verify(key, node, digest, header, payload, *extra):
+                self._deliver(
+                    key,
+                    node,
+                    self._codec.decode(header, payload),
+                    Trace.decode(extra[0]) if extra else None
+                )
+            # Otherwise complain
+            else:
+                self._failures.inc(key=key)
+                print(
+                    "[{}] Unauthenticated message: {}".format(
+                        time.ctime(),
+                        [key, node]
+                    )
+                )
@@ -0,0 +1,152 @@
+import collections
+import Queue
+import threading
+import time
+
+
+class ConflatingQueue():
+    """Provide thread-safe FIFO queue that can conflate items by key.
+
+    Items put with a conflation key replace (or are merged into) a queued
+    item with the same key, keeping its place in line, so consumers that
+    fall behind only ever see the latest version of each.
+    """
+
+    def __init__(self, maxsize=0, overflow="drop", timeout=None):
+        """Provide queue constructor.
+        maxsize is the most items to hold, 0 for unbounded
+        overflow is what to do when full, "block" or "drop" the oldest
+        timeout is the most seconds to block for before dropping the
+        oldest anyway, None to block until there's room
+        """
+
+        # Store parameters
+        self._maxsize = maxsize
+        self._overflow = overflow
+        self._timeout = timeout
+
+        # Queued [key, item] entries, and entries by conflation key
+        self._entries = collections.deque()
+        self._keys = {}
+
+        # Signal consumers and blocked producers
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+        # Counters
+        self._conflated = 0
+        self._dropped = 0
+        self._high_water = 0
+
+    def put(self, item, key=None, merge=None):
+        """Queue item, conflating with any queued item with the same key.
+
+        merge is called as merge(old, new) to combine conflated items,
+        otherwise the new item replaces the old one.
+        """
+
+        with self._lock:
+            # Conflate with the queued item if there is one
+            if key is not None and key in self._keys:
+                entry = self._keys[key]
+                entry[1] = merge(entry[1], item) if merge else item
+                self._conflated += 1
+                return
+
+            # Make room if we're full, waiting a while for it if blocking
+            deadline = (
+                None if self._timeout is None
+                else time.time() + self._timeout
+            )
+            while self._maxsize and len(self._entries) >= self._maxsize:
+                if self._overflow != "block":
+                    self._discard()
+                elif deadline is None:
+                    self._not_full.wait()
+                elif deadline > time.time():
+                    self._not_full.wait(deadline - time.time())
+                else:
+                    self._discard()
+
+            # Queue it
+            entry = [key, item]
+            self._entries.append(entry)
+            if key is not None:
+                self._keys[key] = entry
+
+            self._high_water = max(self._high_water, len(self._entries))
+            self._not_empty.notify()
+
+    def _discard(self):
+        """Drop the oldest entry. Must be called with self._lock held."""
+
+        key, _ = self._entries.popleft()
+        if key is not None:
+            del self._keys[key]
+        self._dropped += 1
+
+    def _pop(self):
+        """Dequeue next item. Must be called with self._lock held."""
+
+        key, item = self._entries.popleft()
+        if key is not None:
+            del self._keys[key]
+        self._not_full.notify()
+        return item
+
+    def _wait(self, block, timeout):
+        """Wait for an item. Must be called with self._lock held."""
+
+        if not block:
+            if not self._entries:
+                raise Queue.Empty
+        elif timeout is None:
+            while not self._entries:
+                self._not_empty.wait()
+        else:
+            deadline = time.time() + timeout
+            while not self._entries:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Queue.Empty
+                self._not_empty.wait(remaining)
+
+    def get(self, block=True, timeout=None):
+        """Dequeue next item, raising Queue.Empty like Queue.Queue.get()."""
+
+        with self._lock:
+            self._wait(block, timeout)
+            return self._pop()
+
+    def get_batch(self, size, block=True, timeout=None):
+        """Dequeue up to size items once at least one is available."""
+
+        with self._lock:
+            self._wait(block, timeout)
+            return [
+                self._pop()
+                for _ in range(min(size, len(self._entries)))
+            ]
+
+    def task_done(self):
+        """Provide Queue.Queue compatibility; nothing is tracked."""
+
+        pass
+
+    def qsize(self):
+        """Return number of queued items."""
+
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        """Return queue depth and counters."""
+
+        with self._lock:
+            return {
+                "depth": len(self._entries),
+                "high_water": self._high_water,
+                "conflated": self._conflated,
+                "dropped": self._dropped
+            }
@@ -0,0 +1,148 @@
+from __future__ import print_function
+
+import errno
+import fcntl
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+import traceback
+import zmq
+
+
+class Reactor():
+    """Provide single-threaded event loop over ZMQ sockets and timers.
+
+    Sockets get callbacks as soon as they're readable and timers fire at
+    their deadlines, so nothing waits on a polling timeout between hops.
+    Callbacks run on the loop thread and mustn't block; other threads
+    hand work over with call_soon() or call_later().
+    """
+
+    def __init__(self):
+        # Readable socket callbacks
+        self._poller = zmq.Poller()
+        self._handlers = {}
+
+        # Heap of (deadline, sequence, func, args), sequence keeping ties
+        # in order and functions from being compared
+        self._timers = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+        # Pipe other threads write to, waking the loop for new timers
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in [self._wake_r, self._wake_w]:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._poller.register(self._wake_r, zmq.POLLIN)
+
+        # Loop thread, once running
+        self._thread = None
+
+    def register(self, socket, callback):
+        """Call callback(socket) whenever socket is readable."""
+
+        self._handlers[socket] = callback
+        self._poller.register(socket, zmq.POLLIN)
+
+    def call_later(self, delay, func, *args):
+        """Call func(*args) on the loop after delay seconds."""
+
+        with self._lock:
+            heapq.heappush(
+                self._timers,
+                (time.time() + delay, next(self._sequence), func, args)
+            )
+
+        # The loop may be asleep on a later deadline
+        if threading.current_thread() is not self._thread:
+            try:
+                os.write(self._wake_w, "x")
+            # Pipe full means it's already awake
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def call_soon(self, func, *args):
+        """Call func(*args) on the loop as soon as possible."""
+
+        self.call_later(0, func, *args)
+
+    def call_every(self, interval, func):
+        """Call func() on the loop now and then every interval seconds.
+
+        interval may instead be a function returning the seconds to wait
+        each time.
+        """
+
+        def tick():
+            try:
+                func()
+            finally:
+                self.call_later(
+                    interval() if callable(interval) else interval,
+                    tick
+                )
+
+        self.call_soon(tick)
+
+    def _due(self):
+        """Pop timers that are due."""
+
+        now = time.time()
+        due = []
+
+        with self._lock:
+            while self._timers and self._timers[0][0] <= now:
+                due.append(heapq.heappop(self._timers))
+
+        return due
+
+    def _timeout(self):
+        """Return ms until the next timer is due, or None if there's none.
+
+        Rounded up, since poll() truncates to whole ms and would otherwise
+        spin through the last one.
+        """
+
+        with self._lock:
+            if not self._timers:
+                return None
+            return int(
+                math.ceil(max(self._timers[0][0] - time.time(), 0) * 1000)
+            )
+
+    def _run(self, func, args):
+        """Run callback, printing anything it raises."""
+
+        try:
+            func(*args)
+        except:
+            print("Exception in reactor.run():")
+            print(traceback.format_exc())
+
+    def run(self):
+        """Run the loop forever in this thread."""
+
+        self._thread = threading.current_thread()
+
+        while True:
+            # Run what's due
+            for _, _, func, args in self._due():
+                self._run(func, args)
+
+            # Sleep until the next deadline or something is readable
+            for socket, _ in self._poller.poll(self._timeout()):
+                # Just woken up, drain the pipe
+                if socket == self._wake_r:
+                    try:
+                        while os.read(self._wake_r, 4096):
+                            pass
+                    except OSError as e:
+                        if e.errno != errno.EAGAIN:
+                            raise
+                else:
+                    self._run(self._handlers[socket], (socket,))
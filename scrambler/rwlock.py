@@ -1,45 +1,88 @@
 import threading
+import time
 
 
 class RWLock():
-    """Provide Read/Write lock helper with writer prioritization."""
+    """Provide Read/Write lock helper with writer prioritization.
+
+    Any number of readers can hold the lock at once, and a writer holds it
+    alone. Waiting writers keep new readers out, but readers that were
+    already waiting when a writer releases aren't held back by the next
+    writer in line, so neither side can starve the other.
+    """
 
     def __init__(self):
-        self._rlock = threading.Lock()   # Reader lock
-        self._wlock = threading.Lock()   # Writer lock
-        self._fence = threading.Event()  # Reader fence to prioritize writers
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0      # Active readers
+        self._writer = False   # Active writer
+        self._waiting = 0      # Waiting writers
+        self._generation = 0   # Writer releases, to let earlier readers in
+
+    def _wait(self, predicate, timeout):
+        """Wait for predicate with self._cond held, false if timed out."""
+
+        if timeout is None:
+            while not predicate():
+                self._cond.wait()
+            return True
+
+        deadline = time.time() + timeout
+        while not predicate():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self._cond.wait(remaining)
+        return True
 
-        # Trap readers when cleared; set initially
-        self._fence.set()
+    def read_acquire(self, timeout=None):
+        with self._cond:
+            generation = self._generation
 
-    def read_acquire(self):
-        # Wait until the fence is open
-        while not self._fence.is_set():
-            self._fence.wait(1)  # Short timeout so our thread can still exit
+            # Wait out the writer, and any queued writers unless they've
+            # had a turn since we arrived
+            if not self._wait(
+                lambda: not self._writer and (
+                    not self._waiting or self._generation != generation
+                ),
+                timeout
+            ):
+                return False
 
-        # Acquire reader
-        self._rlock.acquire()
+            self._readers += 1
+            return True
 
     def read_release(self):
-        # Release to next reader
-        self._rlock.release()
+        with self._cond:
+            self._readers -= 1
 
-    def write_acquire(self):
-        # Acquire writer
-        self._wlock.acquire()
+            # Last reader out wakes writers
+            if not self._readers:
+                self._cond.notify_all()
 
-        # Shut the fence to trap new readers
-        self._fence.clear()
+    def write_acquire(self, timeout=None):
+        with self._cond:
+            self._waiting += 1
 
-        # Wait for current reader and acquire
-        self._rlock.acquire()
+            # Wait for current readers and writer to finish
+            acquired = self._wait(
+                lambda: not self._writer and not self._readers,
+                timeout
+            )
 
-    def write_release(self):
-        # Release to readers
-        self._rlock.release()
+            self._waiting -= 1
+
+            if acquired:
+                self._writer = True
+            # Readers may have been waiting on us
+            elif not self._waiting:
+                self._cond.notify_all()
 
-        # Open the fence for readers so at least one can get through
-        self._fence.set()
+            return acquired
+
+    def write_release(self):
+        with self._cond:
+            self._writer = False
+            self._generation += 1
 
-        # Release to writers
-        self._wlock.release()
+            # Wake everyone; readers waiting before now get in first
+            self._cond.notify_all()
@@ -1,11 +1,134 @@
+import heapq
+import threading
+
+from scrambler.lease import Leases
+
+
+class Index():
+    """Provide incrementally maintained index of running containers.
+
+    Kept up to date from docker state change notifications, it counts
+    running containers by image and node, and tracks which images have
+    changed since the scheduler last looked.
+    """
+
+    def __init__(self, docker_state, leases=None):
+        # Store parameters
+        self._docker_state = docker_state
+        self._leases = leases
+
+        # Running container counts by image then node, and node then image
+        self._images = {}
+        self._nodes = {}
+
+        # Total running containers by node
+        self._loads = {}
+
+        # Images that changed, or None if every image might have
+        self._dirty = None
+
+        self._lock = threading.Lock()
+
+        # Follow changes and index what's there already
+        self._docker_state.watch(self.update)
+        self.update(self._docker_state.keys())
+
+    def update(self, nodes):
+        """Reindex nodes whose docker state changed."""
+
+        for node in nodes:
+            state = self._docker_state.get(node)
+
+            # Count running containers per image
+            counts = {}
+            for image, containers in (state or {}).items():
+                running = sum(
+                    1
+                    for container in containers.values()
+                    if container["state"]
+                )
+                if running:
+                    counts[image] = running
+
+            with self._lock:
+                # Nodes joining or leaving affect every image
+                if (state is None) != (node not in self._nodes):
+                    self._dirty = None
+
+                old = self._nodes.pop(node, {})
+                self._loads.pop(node, None)
+                if state is not None:
+                    self._nodes[node] = counts
+                    self._loads[node] = sum(counts.values())
+
+                # Apply the difference
+                for image in set(old) | set(counts):
+                    if old.get(image) == counts.get(image):
+                        continue
+
+                    if image in counts:
+                        self._images.setdefault(image, {})[node] = (
+                            counts[image]
+                        )
+                    else:
+                        del self._images[image][node]
+                        if not self._images[image]:
+                            del self._images[image]
+
+                    if self._dirty is not None:
+                        self._dirty.add(image)
+
+                    # Containers started, so those runs aren't in flight
+                    started = counts.get(image, 0) - old.get(image, 0)
+                    if self._leases and started > 0:
+                        self._leases.release(("run", image, node), started)
+
+            # Containers gone, so those dies aren't in flight
+            if self._leases:
+                self._leases.settle(node, state)
+
+    def take(self):
+        """Return images changed since last taken, or None for all."""
+
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            return dirty
+
+    def mark(self, images):
+        """Mark images as changed, so they're returned by the next take()."""
+
+        with self._lock:
+            if self._dirty is not None:
+                self._dirty.update(images)
+
+    def nodes(self):
+        """Return indexed nodes."""
+
+        with self._lock:
+            return self._nodes.keys()
+
+    def counts(self, image):
+        """Return running container counts for image by node."""
+
+        with self._lock:
+            return dict(self._images.get(image, {}))
+
+    def loads(self):
+        """Return total running containers by node."""
+
+        with self._lock:
+            return dict(self._loads)
+
+
 class Scheduler():
     """Provide scheduler base class."""
 
-    def __init__(self, policies, cluster_state, docker_state):
+    def __init__(self, policies, cluster_state, docker_state, lease=None):
         """Provide base scheduler constructor.
         policies is an object describing desired cluster state
         cluster_state is the cluster state object
         docker_state is the docker state object
+        lease is how long actions are considered in flight, None for never
         """
 
         # Store parameters
@@ -13,9 +136,41 @@ class Scheduler():
         self._cluster_state = cluster_state
         self._docker_state = docker_state
 
+        # In-flight actions
+        self._leases = Leases(lease) if lease else None
+
+        # Running containers index
+        self._index = Index(self._docker_state, self._leases)
+
         # Action dict for building schedules
         self._actions = {}
 
+    def set_policies(self, policies, images):
+        """Replace policies, rescheduling images whose policies changed
+        and those linking to them."""
+
+        # Names changed images went or go by
+        names = set(
+            policy["name"]
+            for image in images
+            for policy in [self._policies.get(image), policies.get(image)]
+            if policy
+        )
+
+        # Images linking to any of them
+        linked = [
+            image
+            for image, policy in policies.items()
+            if names & set(
+                name
+                for links in policy.get("links", [])
+                for name in links
+            )
+        ]
+
+        self._policies = policies
+        self._index.mark(set(images) | set(linked))
+
     def _prep(self, node):
         """Prepare self._actions common code."""
 
@@ -30,16 +185,36 @@ class Scheduler():
         self._prep(node)
 
         # Add run action
-        self._actions[node]["actions"].append(
-            {
-                "do": "run",
-                "image": image,
-                "name": policy["name"],
-                "config": {
-                    "ports": policy["config"]["ports"]
-                }
+        action = {
+            "do": "run",
+            "image": image,
+            "name": policy["name"],
+            "config": {
+                "ports": policy["config"]["ports"]
             }
-        )
+        }
+        self._actions[node]["actions"].append(action)
+
+        # It's in flight until the container shows up
+        if self._leases:
+            self._leases.acquire(("run", image, node), node, action)
+
+    def _running(self, node, image):
+        """Return running (uuid, container) list for image on node.
+
+        Containers already being killed are left out.
+        """
+
+        dying = self._in_flight("die", image)
+
+        return [
+            (uuid, container)
+            for uuid, container in self._docker_state.get_path(
+                [node, image],
+                {}
+            ).items()
+            if container["state"] and uuid not in dying
+        ]
 
     def _die(self, node, image, containers):
         """Add die actions for containers."""
@@ -49,12 +224,36 @@ class Scheduler():
 
         # For each container UUID
         for uuid, _ in containers:
-            self._actions[node]["actions"].append(
-                {
-                    "do": "die",
-                    "uuid": uuid
-                }
-            )
+            action = {
+                "do": "die",
+                "image": image,
+                "uuid": uuid
+            }
+            self._actions[node]["actions"].append(action)
+
+            # It's in flight until the container is gone
+            if self._leases:
+                self._leases.acquire(("die", image, uuid), node, action)
+
+    def _in_flight(self, kind, image):
+        """Return in-flight action counts for image by node (or uuid)."""
+
+        return self._leases.counts(kind, image) if self._leases else {}
+
+    def _schedule(self):
+        """Return schedule of this pass's actions and any still in flight.
+
+        Actions in flight are sent again, so receivers that track them can
+        tell they're already under way, and ones that missed them don't.
+        """
+
+        return self._leases.actions() if self._leases else self._actions
+
+    def new(self):
+        """Return schedule of the last pass's new actions, leaving out any
+        resent while in flight."""
+
+        return self._actions
 
     def schedule(self):
         """Schedule actions based on policies and docker states.
@@ -76,6 +275,7 @@ class Scheduler():
                 },
                 {
                     "do": "die",
+                    "image": "someimage",
                     "uuid": "someuuid"
                 }
             ]
@@ -96,30 +296,251 @@ class Distribution(Scheduler):
         # Clear actions before scheduling
         self._actions = {}
 
-        # For each image policy
-        for image, policy in self._policies.items():
-            # For each node state
-            for node, state in self._docker_state.items():
-                # If node has containers
-                if image in state:
-                    # Get list of running containers
-                    containers = [
-                        (uuid, container)
-                        for uuid, container in state[image].items()
-                        if container["state"]
-                    ]
-
-                    # If more than one container is running on this node
-                    if len(containers) > 1:
-                        # Add die actions for all but first one
-                        self._die(node, image, containers[1:])
-                # Or if no containers are running on this node
-                else:
+        # Only look at images whose placement changed
+        dirty = self._index.take()
+        if dirty is None:
+            dirty = self._policies.keys()
+
+        # Images still out of spec after this pass
+        pending = []
+
+        nodes = self._index.nodes()
+
+        # For each changed image policy
+        for image in dirty:
+            if image not in self._policies:
+                continue
+
+            counts = self._index.counts(image)
+
+            # Nodes running too many copies
+            surplus = [node for node, count in counts.items() if count > 1]
+
+            # Skip if one copy is running on every node
+            if len(counts) == len(nodes) and not surplus:
+                continue
+
+            pending.append(image)
+
+            # For each node running more than one container
+            for node in surplus:
+                # Add die actions for all but first one
+                self._die(node, image, self._running(node, image)[1:])
+
+            # Runs in flight by node
+            starting = self._in_flight("run", image)
+
+            # For each node without containers or any on the way
+            for node in nodes:
+                if node not in counts and node not in starting:
                     # Add run action
-                    self._run(node, image, policy)
+                    self._run(node, image, self._policies[image])
+
+        # Look again next pass until they're in spec
+        self._index.mark(pending)
 
         # Return action schedule
-        return self._actions
+        return self._schedule()
+
+
+class BinPack(Scheduler):
+    """Implements capacity-aware scheduler honoring policy min/max.
+
+    Keeps between min and max (-1 for unlimited) copies of each image
+    running across the cluster, starting new ones on the least loaded nodes
+    and killing extras on the nodes running the most copies. Policies with
+    affinity prefer nodes running the containers they link to, and
+    require them if strict. Policies without affinity are spread one per
+    node first, then stacked onto the least loaded nodes unless strict.
+
+    Loads go into a heap that is only built when something needs placing,
+    so a pass costs O(nodes + actions * log(nodes)).
+    """
+
+    def schedule(self):
+        """Schedule actions based on policies and docker states."""
+
+        # Clear actions before scheduling
+        self._actions = {}
+
+        # Only look at images whose placement changed
+        dirty = self._index.take()
+        if dirty is None:
+            dirty = self._policies.keys()
+
+        # Node loads including this pass's actions, and heap of them
+        self._loads = None
+        self._heap = None
+
+        # Images still out of spec after this pass
+        pending = []
+
+        for image in dirty:
+            if image not in self._policies:
+                continue
+
+            policy = self._policies[image]
+            counts = self._index.counts(image)
+
+            # Count runs in flight as running, and dies as gone
+            for node, count in self._in_flight("run", image).items():
+                counts[node] = counts.get(node, 0) + count
+            running = (
+                sum(counts.values())
+                - len(self._in_flight("die", image))
+            )
+
+            # Too few
+            if running < policy["min"]:
+                self._place(image, policy, counts, policy["min"] - running)
+            # Too many
+            elif 0 <= policy["max"] < running:
+                self._remove(image, counts, running - policy["max"])
+            # Just right
+            else:
+                continue
+
+            pending.append(image)
+
+        # Look again next pass until they're in spec
+        self._index.mark(pending)
+
+        # Return action schedule
+        return self._schedule()
+
+    def _prepare(self):
+        """Build the node load heap on first use in a pass."""
+
+        if self._loads is None:
+            self._loads = self._index.loads()
+            self._heap = [(load, node) for node, load in self._loads.items()]
+            heapq.heapify(self._heap)
+
+    def _adjust(self, node, change):
+        """Change node's load, keeping the shared heap current."""
+
+        self._loads[node] += change
+        heapq.heappush(self._heap, (self._loads[node], node))
+
+    def _linked(self, policy):
+        """Return nodes running containers the policy links to."""
+
+        names = set(
+            name
+            for links in policy.get("links", [])
+            for name in links
+        )
+
+        return set(
+            node
+            for image, other in self._policies.items()
+            if other["name"] in names
+            for node in self._index.counts(image)
+        )
+
+    def _place(self, image, policy, counts, needed):
+        """Add run actions for needed copies of image."""
+
+        self._prepare()
+        heap = self._heap
+
+        # Affinity narrows candidates to linked nodes, in a heap of their own
+        if policy["affinity"]:
+            linked = [
+                (self._loads[node], node)
+                for node in self._linked(policy)
+                if node in self._loads
+            ]
+
+            if linked:
+                heap = linked
+                heapq.heapify(heap)
+            # Nowhere to go
+            elif policy["strict"]:
+                return
+        # Otherwise spread one per node first
+        else:
+            needed = self._fill(heap, image, policy, counts, needed, True)
+            if policy["strict"]:
+                return
+
+        self._fill(heap, image, policy, counts, needed, False)
+
+    def _fill(self, heap, image, policy, counts, needed, spread):
+        """Add run actions on the least loaded nodes in heap.
+
+        If spread, skip nodes already running image. Returns how many
+        copies are still needed.
+        """
+
+        skipped = []
+
+        while needed and heap:
+            load, node = heapq.heappop(heap)
+
+            # Stale entry, node's load has changed since
+            if self._loads.get(node) != load:
+                continue
+
+            # Already has one
+            if spread and counts.get(node):
+                skipped.append((load, node))
+                continue
+
+            # Add run action
+            self._run(node, image, policy)
+            counts[node] = counts.get(node, 0) + 1
+            needed -= 1
+
+            # Update shared heap, and ours if it's separate
+            self._adjust(node, 1)
+            if heap is not self._heap:
+                heapq.heappush(heap, (load + 1, node))
+
+        # Put back what we skipped
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+
+        return needed
+
+    def _remove(self, image, counts, extra):
+        """Add die actions for extra copies, from nodes running the most."""
+
+        self._prepare()
+
+        # Nodes by most copies, then most loaded
+        heap = [
+            (-count, -self._loads.get(node, 0), node)
+            for node, count in counts.items()
+        ]
+        heapq.heapify(heap)
+
+        # Running containers for nodes we've picked from
+        running = {}
+
+        while extra and heap:
+            count, _, node = heapq.heappop(heap)
+
+            if node not in running:
+                running[node] = self._running(node, image)
+
+            # Index was ahead of the state we can see
+            if not running[node]:
+                continue
+
+            # Add die action
+            self._die(node, image, [running[node].pop()])
+            extra -= 1
+
+            if node in self._loads:
+                self._adjust(node, -1)
+
+            # Still has more to give
+            if count + 1 < 0:
+                heapq.heappush(
+                    heap,
+                    (count + 1, -self._loads.get(node, 0), node)
+                )
 
 
 class RoundRobin(Scheduler):
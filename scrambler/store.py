@@ -1,17 +1,129 @@
+import contextlib
+import threading
+
 from scrambler.synchronized import synchronized
 
 
+# Marks a missing value
+_missing = object()
+
+
+def assign(value, path, leaf):
+    """Return copy of value with leaf set at path, creating dicts as needed.
+
+    Only the dicts along path are copied; value itself is left untouched.
+    """
+
+    if not path:
+        return leaf
+
+    value = dict(value) if isinstance(value, dict) else {}
+    value[path[0]] = assign(value.get(path[0]), path[1:], leaf)
+    return value
+
+
+def remove(value, path, prune=True):
+    """Return copy of value without path, pruning dicts it leaves empty."""
+
+    if not isinstance(value, dict) or path[0] not in value:
+        return value
+
+    value = dict(value)
+
+    if len(path) == 1:
+        del value[path[0]]
+    else:
+        child = remove(value[path[0]], path[1:], prune)
+        if prune and not child:
+            del value[path[0]]
+        else:
+            value[path[0]] = child
+
+    return value
+
+
+def walk(value, path, default=None):
+    """Return what's at path within value, or default."""
+
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return default
+        value = value[key]
+    return value
+
+
+def merge(value, changes, depth=1):
+    """Return copy of value with changes merged in depth levels deep.
+
+    At the last level keys in changes replace those in value, or remove
+    them if None; above it, dicts they leave empty are pruned.
+    """
+
+    value = dict(value) if isinstance(value, dict) else {}
+
+    for key, change in changes.items():
+        if change is None:
+            value.pop(key, None)
+        elif depth > 1:
+            child = merge(value.get(key), change, depth - 1)
+            if child:
+                value[key] = child
+            else:
+                value.pop(key, None)
+        else:
+            value[key] = change
+
+    return value
+
+
+class Stripes():
+    """Provide per-key lock striping."""
+
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def hold(self, keys):
+        """Hold the locks for keys, always taken in the same order."""
+
+        with self._lock:
+            locks = [
+                self._locks.setdefault(key, threading.Lock())
+                for key in sorted(set(keys))
+            ]
+
+        for lock in locks:
+            lock.acquire()
+
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+
 class Store():
-    """Provide thread-safe storage object."""
+    """Provide thread-safe storage object.
 
-    def __init__(self, initialize={}):
+    Writes to different top-level keys only contend briefly, as each key
+    has its own lock, and the path methods update nested values in place
+    of the usual read-modify-write.
+    """
+
+    def __init__(self, initialize=None):
         # Initialize state
-        self._store = initialize
+        self._store = initialize if initialize is not None else {}
+
+        # Per-key writer locks
+        self._stripes = Stripes()
+
+        # Change callbacks
+        self._watchers = []
 
-    @synchronized("write")  # Might write
     def __iter__(self):
-        for item in self._store.items():
-            yield item
+        # Iterate over a copy so we don't hold the lock while the caller works
+        return iter(self.items())
 
     @synchronized("read")
     def __getitem__(self, key):
@@ -33,18 +145,183 @@ class Store():
     def items(self):
         return self._store.items()
 
-    @synchronized("write")
+    def watch(self, callback):
+        """Call callback(keys) with the top-level keys after every write.
+
+        Callbacks run on the writer's thread, so they should be quick.
+        """
+
+        self._watchers.append(callback)
+
+    def _notify(self, keys):
+        """Tell watchers keys changed."""
+
+        for callback in self._watchers:
+            callback(keys)
+
     def __setitem__(self, key, value):
-        self._store[key] = value
+        with self._stripes.hold([key]):
+            self._set({key: value})
+            self._notify([key])
 
-    @synchronized("write")
     def __delitem__(self, key):
-        del self._store[key]
+        with self._stripes.hold([key]):
+            self._delete(key)
+            self._notify([key])
 
-    @synchronized("write")
     def update(self, item):
+        with self._stripes.hold(item.keys()):
+            self._set(item)
+            self._notify(item.keys())
+
+    def get_path(self, path, default=None):
+        """Get value at path, top-level key first, or default."""
+
+        value = self.get(path[0], _missing)
+        if value is _missing:
+            return default
+        return walk(value, path[1:], default)
+
+    def set_path(self, path, value):
+        """Atomically set value at path, creating dicts as needed."""
+
+        self._modify(
+            path[0],
+            lambda current: assign(current, path[1:], value)
+        )
+
+    def delete_path(self, path, prune=True):
+        """Atomically delete path, pruning emptied dicts below the top."""
+
+        if len(path) == 1:
+            self._modify(path[0], lambda current: _missing)
+        else:
+            self._modify(
+                path[0],
+                lambda current: remove(current, path[1:], prune)
+            )
+
+    def merge_path(self, path, changes, depth=1):
+        """Atomically merge changes depth levels deep into value at path."""
+
+        self._modify(
+            path[0],
+            lambda current: assign(
+                current,
+                path[1:],
+                merge(walk(current, path[1:]), changes, depth)
+            )
+        )
+
+    def _modify(self, key, change):
+        """Replace key's value with change(value) under its lock.
+
+        change gets None for a missing key, and returns _missing to delete.
+        """
+
+        with self._stripes.hold([key]):
+            current = self.get(key, _missing)
+            value = change(None if current is _missing else current)
+
+            if value is not _missing:
+                self._set({key: value})
+            elif current is not _missing:
+                self._delete(key)
+            else:
+                return
+
+            self._notify([key])
+
+    @synchronized("write")
+    def _set(self, item):
         self._store.update(item)
 
+    @synchronized("write")
+    def _delete(self, key):
+        del self._store[key]
+
     @synchronized("read")
     def __repr__(self):
         return repr(self._store)
+
+
+class Snapshot(dict):
+    """Provide immutable, versioned point-in-time view of a SnapshotStore."""
+
+    def __init__(self, items, version):
+        dict.__init__(self, items)
+        self.version = version
+
+    def __reduce__(self):
+        return (Snapshot, (dict(self), self.version))
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Snapshot is immutable")
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
+class SnapshotStore(Store):
+    """Provide copy-on-write storage object with lock-free reads.
+
+    Writers build a new Snapshot and swap it in, so readers always see a
+    consistent version without locking. Values must be treated as
+    immutable too: replace them rather than changing them in place.
+    """
+
+    def __init__(self, initialize=None):
+        # Initialize state
+        self._snapshot = Snapshot(initialize or {}, 0)
+
+        # Per-key writer locks, and one to swap snapshots
+        self._stripes = Stripes()
+        self._lock = threading.Lock()
+
+        # Change callbacks
+        self._watchers = []
+
+    def snapshot(self):
+        """Return current Snapshot."""
+
+        return self._snapshot
+
+    def version(self):
+        """Return current Snapshot version, bumped by every write."""
+
+        return self._snapshot.version
+
+    def _write(self, change):
+        """Apply change(items) to a copy of the snapshot and swap it in."""
+
+        with self._lock:
+            items = dict(self._snapshot)
+            change(items)
+            self._snapshot = Snapshot(items, self._snapshot.version + 1)
+
+    def __iter__(self):
+        return iter(self._snapshot.items())
+
+    def __getitem__(self, key):
+        return self._snapshot[key]
+
+    def __contains__(self, key):
+        return key in self._snapshot
+
+    def get(self, key, default=None):
+        return self._snapshot.get(key, default)
+
+    def keys(self):
+        return self._snapshot.keys()
+
+    def items(self):
+        return self._snapshot.items()
+
+    def _set(self, item):
+        self._write(lambda items: items.update(item))
+
+    def _delete(self, key):
+        self._write(lambda items: items.__delitem__(key))
+
+    def __repr__(self):
+        return repr(self._snapshot)
@@ -0,0 +1,240 @@
+from __future__ import print_function
+
+import threading
+import time
+import traceback
+import zmq
+
+from scrambler.auth import Auth
+from scrambler.codec import Codec
+from scrambler.threads import Threads
+
+
+class Sync():
+    """Provide state snapshots to and from peers over a side channel.
+
+    Every agent serves its cluster and docker state, with the version of
+    each node's docker state it reflects, on a ROUTER socket. A joining
+    agent fetches that from the first peer it hears of, so it knows the
+    whole cluster at once and can apply docker deltas from the versions
+    the snapshot was taken at, rather than waiting for everyone's next
+    checkpoint.
+    """
+
+    def __init__(self, config, cluster, docker, reactor=None):
+        # Store config items
+        self._hostname = config["hostname"]
+        self._port = config["sync"]["port"]
+        self._timeout = config["sync"]["timeout"]
+
+        # Store args
+        self._cluster = cluster
+        self._docker = docker
+
+        # Replies are compressed if worth it, and always signed
+        self._codec = Codec(config["codec"]["name"], 1024)
+        self._auth = Auth(config["auth"]["cluster_key"], self._hostname)
+
+        # Synced, or given up waiting to be, as of the deadline
+        self._synced = threading.Event()
+        self._deadline = time.time() + self._timeout
+
+        # Ready callbacks, and whether they've been called
+        self._callbacks = []
+        self._called = False
+        self._lock = threading.Lock()
+
+        # Serve snapshots to peers on the mesh interface, or everywhere,
+        # since our own address may well resolve to loopback
+        self._context = zmq.Context()
+        self._router = self._context.socket(zmq.ROUTER)
+        self._router.setsockopt(zmq.LINGER, 0)
+        self._router.bind(
+            "tcp://{}:{}".format(
+                config["connection"]["interface"] or "*",
+                self._port
+            )
+        )
+
+        # Serve on the loop, or start daemon worker threads
+        if reactor:
+            reactor.register(self._router, self.serve_one)
+            Threads([self.fetch])
+        else:
+            Threads([self.serve, self.fetch])
+
+    def ready(self):
+        """Return true once synced, or once it's too late to wait for."""
+
+        return self._synced.is_set() or time.time() >= self._deadline
+
+    def on_ready(self, callback):
+        """Call callback() once ready, or now if already."""
+
+        with self._lock:
+            if not self._called:
+                self._callbacks.append(callback)
+                return
+
+        callback()
+
+    def _ready(self):
+        """Tell ready callbacks, once."""
+
+        with self._lock:
+            callbacks, self._callbacks = self._callbacks, []
+            self._called = True
+
+        for callback in callbacks:
+            callback()
+
+    def _restored(self, node):
+        """Note the snapshot from node has been applied."""
+
+        self._synced.set()
+
+        print("[{}] Synced state from {}".format(time.ctime(), node))
+
+    def serve_one(self, socket):
+        """Reply to a snapshot request from an authenticated peer."""
+
+        identity, node, digest = socket.recv_multipart()
+
+        if not self._auth.verify(digest, node):
+            print(
+                "[{}] Unauthenticated snapshot request from {}".format(
+                    time.ctime(),
+                    node
+                )
+            )
+            return
+
+        header, payload = self._codec.encode(
+            {
+                "cluster": dict(self._cluster.get_state().snapshot()),
+                "docker": self._docker.snapshot()
+            }
+        )
+
+        socket.send_multipart(
+            [
+                identity,
+                self._hostname,
+                self._auth.sign(self._hostname, header, payload),
+                header,
+                payload
+            ]
+        )
+
+    def serve(self):
+        """Serve snapshot requests."""
+
+        # Register poller for incoming requests
+        poller = zmq.Poller()
+        poller.register(self._router, zmq.POLLIN)
+
+        while True:
+            try:
+                # Wait for request
+                sockets = dict(poller.poll(1000))  # In ms
+
+                # Got one? Answer it
+                if self._router in sockets:
+                    self.serve_one(self._router)
+            # Print anything else and continue
+            except:
+                print("Exception in sync.serve():")
+                print(traceback.format_exc())
+
+    def _request(self, peer, address):
+        """Return snapshot from peer at address, or None if it doesn't
+        answer in time, can't be trusted or turns out to be someone else."""
+
+        dealer = self._context.socket(zmq.DEALER)
+        dealer.setsockopt(zmq.LINGER, 0)
+
+        try:
+            dealer.connect("tcp://{}:{}".format(address, self._port))
+            dealer.send_multipart([self._hostname, self._auth.digest()])
+
+            # Give up on it in time to try someone else
+            if not dealer.poll(1000):  # In ms
+                return None
+
+            node, signature, header, payload = dealer.recv_multipart()
+
+            if not self._auth.verify_signature(
+                signature,
+                node,
+                header,
+                payload
+            ):
+                print(
+                    "[{}] Unauthenticated snapshot from {}".format(
+                        time.ctime(),
+                        node
+                    )
+                )
+                return None
+
+            # Whoever's at that address now, like us via a stale address,
+            # isn't who we asked
+            if node != peer or node == self._hostname:
+                print(
+                    "[{}] Snapshot for {} came from {}".format(
+                        time.ctime(),
+                        peer,
+                        node
+                    )
+                )
+                return None
+
+            return self._codec.decode(header, payload)
+        finally:
+            dealer.close()
+
+    def fetch(self):
+        """Fetch a snapshot from the first peer that'll give us one."""
+
+        # Peers already asked
+        asked = set()
+
+        while not self.ready():
+            try:
+                # Anyone we've heard announce themselves
+                peers = [
+                    (node, state["address"])
+                    for node, state in self._cluster.get_state().items()
+                    if node != self._hostname and node not in asked
+                ]
+
+                # Nobody yet
+                if not peers:
+                    time.sleep(0.1)
+                    continue
+
+                node, address = peers[0]
+                asked.add(node)
+
+                snapshot = self._request(node, address)
+                if snapshot is None:
+                    continue
+
+                # Take on their view, then carry on from it live, synced
+                # only once the handler's applied it
+                self._cluster.restore(snapshot["cluster"])
+                self._docker.restore(
+                    snapshot["docker"],
+                    lambda: self._restored(node)
+                )
+                break
+            # Print anything else and continue
+            except:
+                print("Exception in sync.fetch():")
+                print(traceback.format_exc())
+                time.sleep(1)
+
+        # Wait for it to be applied, or to be too late to wait for
+        self._synced.wait(max(self._deadline - time.time(), 0))
+
+        self._ready()
@@ -11,13 +11,15 @@ def synchronized(access):
             rwlock = getattr(self, "_rwlock")
             if access == "read":
                 rwlock.read_acquire()
-                result = method(self, *args, **kwargs)
-                rwlock.read_release()
-                return result
+                try:
+                    return method(self, *args, **kwargs)
+                finally:
+                    rwlock.read_release()
             elif access == "write":
                 rwlock.write_acquire()
-                result = method(self, *args, **kwargs)
-                rwlock.write_release()
-                return result
+                try:
+                    return method(self, *args, **kwargs)
+                finally:
+                    rwlock.write_release()
         return synced
     return decorator
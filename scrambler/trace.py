@@ -0,0 +1,71 @@
+import json
+import time
+import uuid as uuidlib
+
+from scrambler.metrics import registry
+
+# Per-stage latencies of traced changes
+_stages = registry.histogram(
+    "scrambler_trace_stage_seconds",
+    "Time traced changes took to reach each stage from the one before"
+)
+_elapsed = registry.histogram(
+    "scrambler_trace_elapsed_seconds",
+    "Time traced changes took to reach each stage from the first"
+)
+
+
+class Trace():
+    """Provide timestamps of a change at each stage it goes through.
+
+    Traces travel with messages, from a node dying or a schedule being
+    made through to the resulting containers showing up in state, and
+    each stage reached is timed against the previous one and the first.
+    Stages reached on different nodes are only as comparable as their
+    clocks.
+    """
+
+    def __init__(self, stage=None, id=None, stages=None):
+        """Provide trace constructor.
+        stage is the stage to start at, if any
+        id and stages continue a trace received from elsewhere
+        """
+
+        self.id = id or uuidlib.uuid4().hex[:16]
+        self.stages = stages or []
+
+        if stage:
+            self.mark(stage)
+
+    def mark(self, stage):
+        """Note that stage has been reached, now."""
+
+        now = time.time()
+
+        if self.stages:
+            _stages.observe(now - self.stages[-1][1], stage=stage)
+            _elapsed.observe(now - self.stages[0][1], stage=stage)
+
+        self.stages.append([stage, now])
+
+    def last(self):
+        """Return when the latest stage was reached."""
+
+        return self.stages[-1][1] if self.stages else None
+
+    def copy(self):
+        """Return a trace to carry on separately from here."""
+
+        return Trace(id=self.id, stages=list(self.stages))
+
+    def encode(self):
+        """Return trace as a message frame."""
+
+        return json.dumps([self.id, self.stages])
+
+    @classmethod
+    def decode(cls, frame):
+        """Return trace from a message frame."""
+
+        id, stages = json.loads(frame)
+        return cls(id=id, stages=stages)
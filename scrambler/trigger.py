@@ -0,0 +1,84 @@
+import threading
+import time
+
+
+class Trigger():
+    """Provide debounced change notification for event-driven loops.
+
+    Changes are gathered until none have arrived for the debounce window,
+    but never for longer than the staleness bound after the first one.
+    """
+
+    def __init__(self, debounce, staleness):
+        # Store parameters
+        self._debounce = debounce
+        self._staleness = staleness
+
+        # Time of the first and last changes not yet handled
+        self._first = None
+        self._last = None
+
+        self._cond = threading.Condition(threading.Lock())
+
+    def fire(self, *args):
+        """Note a change, returning true if it's the first not yet handled.
+
+        Accepts and ignores arguments to suit callbacks.
+        """
+
+        with self._cond:
+            self._last = time.time()
+            first = self._first is None
+            if first:
+                self._first = self._last
+            self._cond.notify()
+            return first
+
+    def _remaining(self):
+        """Return seconds left to wait for changes to settle, or None if
+        there are none. Must be called with self._cond held."""
+
+        if self._first is None:
+            return None
+
+        until = min(self._last + self._debounce, self._first + self._staleness)
+        return max(until - time.time(), 0)
+
+    def poll(self):
+        """Return (settled, remaining) without waiting.
+
+        Settled changes are taken as handled; otherwise remaining is how
+        long until they might settle, or None if there are none.
+        """
+
+        with self._cond:
+            remaining = self._remaining()
+            if remaining == 0:
+                self._first = self._last = None
+                return True, None
+            return False, remaining
+
+    def wait(self, timeout=None):
+        """Wait for changes to settle, returning false on timeout."""
+
+        with self._cond:
+            # Wait for a change
+            deadline = None if timeout is None else time.time() + timeout
+            while self._first is None:
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+
+            # Then for things to quiet down, or get too stale to wait on
+            while True:
+                remaining = self._remaining()
+                if not remaining:
+                    break
+                self._cond.wait(remaining)
+
+            self._first = self._last = None
+            return True
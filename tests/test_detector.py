@@ -0,0 +1,116 @@
+import threading
+import time
+import unittest
+
+from scrambler.detector import Detector, phi
+
+
+class Expired():
+    """Record expired nodes, and when."""
+
+    def __init__(self):
+        self.nodes = {}
+        self._event = threading.Event()
+
+    def __call__(self, node):
+        self.nodes[node] = time.time()
+        self._event.set()
+
+    def wait(self, timeout):
+        return self._event.wait(timeout)
+
+
+def detector(
+    expired,
+    min_std=0.01,
+    pause=1,
+    interval=0.02,
+    limit=10
+):
+    """Return detector with threshold 8, fast enough to test."""
+
+    return Detector(expired, 8, 100, min_std, pause, interval, limit)
+
+
+class PhiTest(unittest.TestCase):
+    def test_grows_with_lateness(self):
+        self.assertLess(phi(1.0, 1.0, 0.1), 1)
+        self.assertLess(phi(1.1, 1.0, 0.1), phi(1.2, 1.0, 0.1))
+        self.assertGreater(phi(2.0, 1.0, 0.1), 8)
+
+
+class DetectorTest(unittest.TestCase):
+    def test_expires_once_deadline_passes(self):
+        expired = Expired()
+        started = time.time()
+
+        detector(expired).heartbeat("node")
+
+        self.assertTrue(expired.wait(1))
+
+        # Mean of one interval plus over five deviations
+        self.assertGreaterEqual(expired.nodes["node"] - started, 0.07)
+
+    def test_heartbeats_keep_node_alive(self):
+        expired = Expired()
+        instance = detector(expired)
+
+        for _ in range(20):
+            instance.heartbeat("node")
+            time.sleep(0.02)
+
+        self.assertEqual(expired.nodes, {})
+        self.assertTrue(expired.wait(1))
+        self.assertEqual(list(expired.nodes), ["node"])
+
+    def test_pause_floors_deadline(self):
+        expired = Expired()
+        started = time.time()
+
+        detector(expired, pause=10).heartbeat("node")
+
+        self.assertFalse(expired.wait(0.15))
+        self.assertTrue(expired.wait(1))
+        self.assertGreaterEqual(expired.nodes["node"] - started, 0.2)
+
+    def test_limit_caps_deadline(self):
+        expired = Expired()
+        started = time.time()
+
+        detector(expired, min_std=10, limit=0.05).heartbeat("node")
+
+        self.assertTrue(expired.wait(1))
+        self.assertLess(expired.nodes["node"] - started, 0.5)
+
+    def test_slower_nodes_get_longer(self):
+        expired = Expired()
+        started = time.time()
+
+        # Beating five times slower than usual, so five times the limit
+        detector(expired, min_std=10, limit=0.05).heartbeat("node", 0.1)
+
+        self.assertTrue(expired.wait(1))
+        self.assertGreaterEqual(expired.nodes["node"] - started, 0.25)
+
+    def test_forgotten_nodes_dont_expire(self):
+        expired = Expired()
+        instance = detector(expired)
+
+        instance.heartbeat("node")
+        instance.forget("node")
+
+        self.assertFalse(expired.wait(0.2))
+        self.assertEqual(instance.phi("node"), None)
+
+    def test_phi_rises_with_silence(self):
+        instance = detector(Expired(), pause=100)
+
+        instance.heartbeat("node")
+        before = instance.phi("node")
+        time.sleep(0.05)
+
+        self.assertGreater(instance.phi("node"), before)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import time
+import unittest
+
+from scrambler.lease import Leases
+
+
+class LeasesTest(unittest.TestCase):
+    def test_acquire_counts_leases(self):
+        leases = Leases(60)
+
+        leases.acquire(("run", "image", "node1"), "node1", {"do": "run"})
+        leases.acquire(("run", "image", "node1"), "node1", {"do": "run"})
+        leases.acquire(("run", "image", "node2"), "node2", {"do": "run"})
+
+        self.assertEqual(leases.count(("run", "image", "node1")), 2)
+        self.assertEqual(
+            leases.counts("run", "image"),
+            {"node1": 2, "node2": 1}
+        )
+        self.assertEqual(leases.counts("die", "image"), {})
+
+    def test_release_oldest(self):
+        leases = Leases(60)
+        first = {"do": "run", "name": "first"}
+        second = {"do": "run", "name": "second"}
+
+        leases.acquire(("run", "image", "node"), "node", first)
+        leases.acquire(("run", "image", "node"), "node", second)
+        leases.release(("run", "image", "node"))
+
+        self.assertEqual(
+            leases.actions(),
+            {"node": {"actions": [second]}}
+        )
+
+        # Releasing more than are held just empties it
+        leases.release(("run", "image", "node"), 5)
+
+        self.assertEqual(leases.count(("run", "image", "node")), 0)
+        self.assertEqual(leases.actions(), {})
+
+    def test_leases_expire(self):
+        leases = Leases(0.01)
+
+        leases.acquire(("run", "image", "node"), "node", {"do": "run"})
+        time.sleep(0.02)
+
+        self.assertEqual(leases.count(("run", "image", "node")), 0)
+        self.assertEqual(leases.actions(), {})
+
+    def test_settle_releases_dies_of_gone_containers(self):
+        leases = Leases(60)
+
+        leases.acquire(("die", "image", "gone"), "node", {"do": "die"})
+        leases.acquire(("die", "image", "alive"), "node", {"do": "die"})
+        leases.acquire(("die", "image", "other"), "other", {"do": "die"})
+        leases.acquire(("run", "image", "node"), "node", {"do": "run"})
+
+        leases.settle(
+            "node",
+            {"image": {"alive": {"name": "/alive", "state": True}}}
+        )
+
+        self.assertEqual(
+            leases.counts("die", "image"),
+            {"alive": 1, "other": 1}
+        )
+        self.assertEqual(leases.count(("run", "image", "node")), 1)
+
+    def test_settle_node_gone(self):
+        leases = Leases(60)
+
+        leases.acquire(("die", "image", "uuid"), "node", {"do": "die"})
+        leases.settle("node", None)
+
+        self.assertEqual(leases.counts("die", "image"), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import Queue
+import threading
+import time
+import unittest
+
+from scrambler.queues import ConflatingQueue
+
+
+class ConflatingQueueTest(unittest.TestCase):
+    def test_fifo(self):
+        queue = ConflatingQueue()
+
+        for item in range(3):
+            queue.put(item)
+
+        self.assertEqual([queue.get() for _ in range(3)], [0, 1, 2])
+        self.assertRaises(Queue.Empty, queue.get, False)
+        self.assertRaises(Queue.Empty, queue.get, True, 0.01)
+
+    def test_conflates_by_key_in_place(self):
+        queue = ConflatingQueue()
+
+        queue.put("a1", "a")
+        queue.put("b1", "b")
+        queue.put("a2", "a")
+        queue.put("none")
+
+        self.assertEqual(queue.get_batch(10), ["a2", "b1", "none"])
+        self.assertEqual(queue.stats()["conflated"], 1)
+
+        # Gone once taken, so the next one queues afresh
+        queue.put("a3", "a")
+        self.assertEqual(queue.get(), "a3")
+
+    def test_conflates_with_merge(self):
+        queue = ConflatingQueue()
+
+        queue.put({"x": 1}, "a", lambda old, new: dict(old, **new))
+        queue.put({"y": 2}, "a", lambda old, new: dict(old, **new))
+
+        self.assertEqual(queue.get(), {"x": 1, "y": 2})
+
+    def test_drops_oldest_when_full(self):
+        queue = ConflatingQueue(2)
+
+        for item in range(3):
+            queue.put(item)
+
+        self.assertEqual(queue.get_batch(10), [1, 2])
+        self.assertEqual(queue.stats()["dropped"], 1)
+        self.assertEqual(queue.stats()["high_water"], 2)
+
+    def test_conflating_doesnt_need_room(self):
+        queue = ConflatingQueue(1, "block", 0.01)
+
+        queue.put("a1", "a")
+        queue.put("a2", "a")
+
+        self.assertEqual(queue.stats()["dropped"], 0)
+        self.assertEqual(queue.get(), "a2")
+
+    def test_blocks_then_drops_oldest(self):
+        queue = ConflatingQueue(1, "block", 0.05)
+        queue.put(0)
+
+        started = time.time()
+        queue.put(1)
+
+        self.assertGreaterEqual(time.time() - started, 0.05)
+        self.assertEqual(queue.get_batch(10), [1])
+        self.assertEqual(queue.stats()["dropped"], 1)
+
+    def test_blocks_until_room(self):
+        queue = ConflatingQueue(1, "block", 1)
+        queue.put(0)
+
+        timer = threading.Timer(0.05, queue.get)
+        timer.start()
+
+        queue.put(1)
+        timer.join()
+
+        self.assertEqual(queue.get_batch(10), [1])
+        self.assertEqual(queue.stats()["dropped"], 0)
+
+    def test_get_waits_for_put(self):
+        queue = ConflatingQueue()
+
+        timer = threading.Timer(0.05, queue.put, ["item"])
+        timer.start()
+
+        self.assertEqual(queue.get(timeout=1), "item")
+        timer.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import threading
+import time
+import unittest
+
+from scrambler.rwlock import RWLock
+
+
+def start(target, *args):
+    """Start daemon thread running target, returning it."""
+
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class RWLockTest(unittest.TestCase):
+    def test_concurrent_readers(self):
+        lock = RWLock()
+        lock.read_acquire()
+
+        acquired = []
+        start(lambda: acquired.append(lock.read_acquire(timeout=1))).join()
+
+        self.assertEqual(acquired, [True])
+
+    def test_writer_excludes_readers_and_writers(self):
+        lock = RWLock()
+        lock.write_acquire()
+
+        self.assertFalse(lock.read_acquire(timeout=0.05))
+        self.assertFalse(lock.write_acquire(timeout=0.05))
+
+        lock.write_release()
+
+        self.assertTrue(lock.read_acquire(timeout=0.05))
+
+    def test_waiting_writer_keeps_new_readers_out(self):
+        lock = RWLock()
+        lock.read_acquire()
+
+        writing = threading.Event()
+
+        def writer():
+            lock.write_acquire()
+            writing.set()
+            lock.write_release()
+
+        thread = start(writer)
+        time.sleep(0.05)
+
+        # Queued behind the writer
+        self.assertFalse(lock.read_acquire(timeout=0.05))
+        self.assertFalse(writing.is_set())
+
+        # Writer goes once the reader that beat it leaves
+        lock.read_release()
+        thread.join(1)
+
+        self.assertTrue(writing.is_set())
+
+    def test_writer_not_starved_by_stream_of_readers(self):
+        lock = RWLock()
+        stop = threading.Event()
+
+        def reader():
+            while not stop.is_set():
+                lock.read_acquire()
+                time.sleep(0.001)
+                lock.read_release()
+
+        threads = [start(reader) for _ in range(4)]
+        time.sleep(0.05)
+
+        try:
+            self.assertTrue(lock.write_acquire(timeout=2))
+            lock.write_release()
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join(1)
+
+    def test_readers_waiting_before_release_go_before_next_writer(self):
+        lock = RWLock()
+        lock.write_acquire()
+
+        read = threading.Event()
+
+        def reader():
+            lock.read_acquire()
+            read.set()
+
+        start(reader)
+        time.sleep(0.05)
+
+        # Another writer queues up as the first releases
+        writer = start(lock.write_acquire)
+        time.sleep(0.05)
+        lock.write_release()
+
+        self.assertTrue(read.wait(1))
+
+        # And the writer gets in once the reader's done
+        lock.read_release()
+        writer.join(1)
+        self.assertFalse(writer.is_alive())
+
+    def test_write_acquire_timeout(self):
+        lock = RWLock()
+        lock.read_acquire()
+
+        started = time.time()
+        self.assertFalse(lock.write_acquire(timeout=0.05))
+        self.assertGreaterEqual(time.time() - started, 0.05)
+
+        # Giving up lets readers back in
+        self.assertTrue(lock.read_acquire(timeout=0.05))
+
+    def test_read_acquire_timeout(self):
+        lock = RWLock()
+        lock.write_acquire()
+
+        started = time.time()
+        self.assertFalse(lock.read_acquire(timeout=0.05))
+        self.assertGreaterEqual(time.time() - started, 0.05)
+
+
+if __name__ == "__main__":
+    unittest.main()
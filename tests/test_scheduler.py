@@ -0,0 +1,322 @@
+import itertools
+import unittest
+
+from scrambler.scheduler import BinPack, Index
+from scrambler.store import SnapshotStore
+
+
+serial = itertools.count()
+
+
+def containers(image, count):
+    """Return state of count running containers of image."""
+
+    return {
+        image: dict(
+            (
+                "{:064x}".format(next(serial)),
+                {"name": "/container", "state": True}
+            )
+            for _ in range(count)
+        )
+    }
+
+
+def policy(
+    name,
+    minimum,
+    maximum=-1,
+    links=None,
+    affinity=False,
+    strict=False
+):
+    """Return a container policy."""
+
+    return {
+        "name": name,
+        "min": minimum,
+        "max": maximum,
+        "links": [dict((link, link) for link in links or [])],
+        "affinity": affinity,
+        "strict": strict,
+        "config": {"ports": {}}
+    }
+
+
+def runs(actions, image):
+    """Return run action counts for image by node."""
+
+    return dict(
+        (node, count)
+        for node, count in (
+            (
+                node,
+                sum(
+                    1
+                    for action in scheduled["actions"]
+                    if action["do"] == "run" and action["image"] == image
+                )
+            )
+            for node, scheduled in actions.items()
+        )
+        if count
+    )
+
+
+def dies(actions):
+    """Return die action uuids by node."""
+
+    return dict(
+        (
+            node,
+            [
+                action["uuid"]
+                for action in scheduled["actions"]
+                if action["do"] == "die"
+            ]
+        )
+        for node, scheduled in actions.items()
+    )
+
+
+def apply(docker_state, actions):
+    """Apply actions to docker state as if they'd run."""
+
+    for node, scheduled in actions.items():
+        state = dict(docker_state.get(node, {}))
+        for action in scheduled["actions"]:
+            image = action["image"]
+            running = dict(state.get(image, {}))
+            if action["do"] == "run":
+                running.update(containers(image, 1)[image])
+            else:
+                del running[action["uuid"]]
+            state[image] = running
+        docker_state[node] = state
+
+
+class IndexTest(unittest.TestCase):
+    def test_counts_existing_state(self):
+        docker_state = SnapshotStore(
+            {
+                "node1": containers("a", 2),
+                "node2": dict(containers("a", 1), **containers("b", 3))
+            }
+        )
+
+        index = Index(docker_state)
+
+        self.assertEqual(sorted(index.nodes()), ["node1", "node2"])
+        self.assertEqual(index.counts("a"), {"node1": 2, "node2": 1})
+        self.assertEqual(index.counts("b"), {"node2": 3})
+        self.assertEqual(index.loads(), {"node1": 2, "node2": 4})
+
+    def test_stopped_containers_not_counted(self):
+        state = containers("a", 2)
+        state["a"].values()[0]["state"] = False
+
+        index = Index(SnapshotStore({"node": state}))
+
+        self.assertEqual(index.counts("a"), {"node": 1})
+
+    def test_changes_mark_only_changed_images(self):
+        docker_state = SnapshotStore(
+            {"node": dict(containers("a", 1), **containers("b", 1))}
+        )
+        index = Index(docker_state)
+
+        # Everything's new at first
+        self.assertEqual(index.take(), None)
+        self.assertEqual(index.take(), set())
+
+        docker_state["node"] = dict(
+            docker_state["node"],
+            **containers("a", 2)
+        )
+
+        self.assertEqual(index.counts("a"), {"node": 2})
+        self.assertEqual(index.take(), set(["a"]))
+
+    def test_node_joining(self):
+        docker_state = SnapshotStore({"node1": containers("a", 1)})
+        index = Index(docker_state)
+        index.take()
+
+        docker_state["node2"] = containers("a", 2)
+
+        self.assertEqual(index.counts("a"), {"node1": 1, "node2": 2})
+        self.assertEqual(index.loads(), {"node1": 1, "node2": 2})
+
+        # A new node affects every image
+        self.assertEqual(index.take(), None)
+
+    def test_node_leaving(self):
+        docker_state = SnapshotStore(
+            {
+                "node1": containers("a", 1),
+                "node2": dict(containers("a", 2), **containers("b", 1))
+            }
+        )
+        index = Index(docker_state)
+        index.take()
+
+        del docker_state["node2"]
+
+        self.assertEqual(index.nodes(), ["node1"])
+        self.assertEqual(index.counts("a"), {"node1": 1})
+        self.assertEqual(index.counts("b"), {})
+        self.assertEqual(index.loads(), {"node1": 1})
+        self.assertEqual(index.take(), None)
+
+
+class BinPackTest(unittest.TestCase):
+    def scheduler(self, policies, state, lease=None):
+        docker_state = SnapshotStore(state)
+        return (
+            BinPack(policies, SnapshotStore(), docker_state, lease),
+            docker_state
+        )
+
+    def test_converges_to_min(self):
+        scheduler, docker_state = self.scheduler(
+            {"a": policy("a", 3)},
+            {"node1": {}, "node2": {}, "node3": {}},
+            60
+        )
+
+        actions = scheduler.schedule()
+        self.assertEqual(
+            runs(actions, "a"),
+            {"node1": 1, "node2": 1, "node3": 1}
+        )
+
+        apply(docker_state, actions)
+
+        # Started, so nothing's in flight or left to do
+        self.assertEqual(scheduler.schedule(), {})
+
+    def test_converges_to_max(self):
+        scheduler, docker_state = self.scheduler(
+            {"a": policy("a", 1, 2)},
+            {"node1": containers("a", 3), "node2": containers("a", 2)},
+            60
+        )
+
+        actions = scheduler.schedule()
+        self.assertEqual(
+            sum(len(uuids) for uuids in dies(actions).values()),
+            3
+        )
+
+        apply(docker_state, actions)
+
+        self.assertEqual(scheduler.schedule(), {})
+        self.assertEqual(
+            sum(len(state["a"]) for _, state in docker_state.items()),
+            2
+        )
+
+    def test_in_flight_not_scheduled_again(self):
+        policies = {"a": policy("a", 2)}
+        scheduler, _ = self.scheduler(
+            policies,
+            {"node1": {}, "node2": {}},
+            60
+        )
+
+        first = scheduler.schedule()
+        self.assertEqual(scheduler.new(), first)
+
+        scheduler.set_policies(policies, ["a"])
+        second = scheduler.schedule()
+
+        # Resent as they were, nothing added
+        self.assertEqual(second, first)
+        self.assertEqual(scheduler.new(), {})
+
+    def test_spreads_then_stacks(self):
+        scheduler, _ = self.scheduler(
+            {"a": policy("a", 5)},
+            {"node1": containers("b", 1), "node2": {}}
+        )
+
+        actions = scheduler.schedule()
+
+        # One each, then the rest on the least loaded
+        self.assertEqual(runs(actions, "a"), {"node1": 2, "node2": 3})
+
+    def test_strict_spread_never_stacks(self):
+        scheduler, _ = self.scheduler(
+            {"a": policy("a", 5, strict=True)},
+            {"node1": containers("a", 1), "node2": {}, "node3": {}}
+        )
+
+        actions = scheduler.schedule()
+
+        self.assertEqual(runs(actions, "a"), {"node2": 1, "node3": 1})
+
+    def test_affinity_prefers_linked_nodes(self):
+        scheduler, _ = self.scheduler(
+            {
+                "a": policy("a", 2, links=["b"], affinity=True),
+                "b": policy("b", 1)
+            },
+            {"node1": {}, "node2": containers("b", 1), "node3": {}}
+        )
+
+        actions = scheduler.schedule()
+
+        self.assertEqual(runs(actions, "a"), {"node2": 2})
+
+    def test_affinity_falls_back_unless_strict(self):
+        policies = {
+            "a": policy("a", 2, links=["b"], affinity=True),
+            "b": policy("b", 0)
+        }
+        state = {"node1": {}, "node2": {}}
+
+        # Nothing linked to run alongside, so anywhere will do
+        scheduler, _ = self.scheduler(policies, state)
+        self.assertEqual(
+            runs(scheduler.schedule(), "a"),
+            {"node1": 1, "node2": 1}
+        )
+
+        # Or nowhere, if strict
+        policies["a"] = policy(
+            "a",
+            2,
+            links=["b"],
+            affinity=True,
+            strict=True
+        )
+        scheduler, _ = self.scheduler(policies, state)
+        self.assertEqual(scheduler.schedule(), {})
+
+    def test_removes_from_most_copies_then_most_loaded(self):
+        scheduler, docker_state = self.scheduler(
+            {"a": policy("a", 1, 2), "b": policy("b", 0)},
+            {
+                "node1": containers("a", 3),
+                "node2": containers("a", 1),
+                "node3": dict(containers("a", 1), **containers("b", 5))
+            }
+        )
+
+        actions = scheduler.schedule()
+        removed = dict(
+            (node, len(uuids))
+            for node, uuids in dies(actions).items()
+        )
+
+        # Two from the node with the most, then the busiest of the rest
+        self.assertEqual(removed, {"node1": 2, "node3": 1})
+
+        # And they're ones that were running there
+        for node, uuids in dies(actions).items():
+            for uuid in uuids:
+                self.assertIn(uuid, docker_state[node]["a"])
+
+
+if __name__ == "__main__":
+    unittest.main()